@@ -0,0 +1,62 @@
+#! /usr/bin/env python3
+#
+# Replays a synthetic history through ChangeSet and reports how long it takes
+# to resolve the changes.
+#
+# usage: bench/changeset.py [entries]
+#
+
+import os, sys
+import random
+import time
+
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), '..'))
+
+from lieer.changeset import ChangeSet
+
+def synthetic_history (n, messages, seed = 42):
+  """
+  Generate `n` history records touching a pool of `messages` message ids,
+  roughly distributed like a mailbox that has been offline for a while.
+  """
+  rnd    = random.Random (seed)
+  labels = [ 'INBOX', 'UNREAD', 'STARRED', 'IMPORTANT', 'Label_1', 'Label_2' ]
+  kinds  = [ 'messagesAdded', 'messagesDeleted', 'labelsAdded', 'labelsRemoved' ]
+
+  for i in range (n):
+    gid  = '%016x' % rnd.randrange (messages)
+    kind = rnd.choices (kinds, weights = [ 3, 1, 4, 4 ])[0]
+    m    = { 'id' : gid, 'labelIds' : rnd.sample (labels, rnd.randrange (1, 4)) }
+
+    if kind == 'messagesAdded' or kind == 'messagesDeleted':
+      yield { 'id' : str(i), kind : [ { 'message' : m } ] }
+    else:
+      yield { 'id' : str(i), kind : [ { 'message' : m, 'labelIds' : m['labelIds'][:1] } ] }
+
+def main ():
+  n        = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+  messages = n // 4
+
+  history = list (synthetic_history (n, messages))
+  local   = set ('%016x' % i for i in range (0, messages, 2))
+
+  t0 = time.perf_counter ()
+
+  changes = ChangeSet (local.__contains__, set (['CHAT']))
+  for h in history:
+    changes.apply (h)
+
+  added   = changes.added_messages
+  deleted = changes.deleted_messages
+  changed = changes.changed_messages
+
+  dt = time.perf_counter () - t0
+
+  print ("history entries ....: %d" % n)
+  print ("added ..............: %d" % len(added))
+  print ("deleted ............: %d" % len(deleted))
+  print ("labels changed .....: %d" % len(changed))
+  print ("resolved in ........: %.2f s (%.0f entries/s)" % (dt, n / dt))
+
+if __name__ == '__main__':
+  main ()
@@ -0,0 +1,537 @@
+#! /usr/bin/env python3
+#
+# A local stand-in for the parts of the GMail REST API used by gmailieer,
+# backed by a synthetic mailbox. Supports labels.list/create,
+# messages.list/get/modify/batchModify, history.list and batch requests, and
+# can inject errors at random.
+#
+# usage: bench/fakegmail.py [-p PORT] [-n MESSAGES] [--fail 403=0.01,500=0.001]
+#
+# point gmailieer at it with:
+#
+#   GMAILIEER_DISCOVERY_URL=http://127.0.0.1:PORT/discovery/v1/apis/gmail/v1/rest gmi pull
+#
+# the server does not check authorization, any stored credentials will do.
+#
+
+import re
+import sys
+import json
+import uuid
+import base64
+import random
+import argparse
+import threading
+import email.parser
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class NotFound (Exception):
+  pass
+
+class Mailbox:
+  """
+  Messages, labels and history of a synthetic GMail account.
+
+  The message content is generated from the message id when requested, so
+  only the labels and history id of each message are kept in memory.
+  """
+
+  SYSTEM_LABELS = [ 'INBOX', 'SPAM', 'TRASH', 'UNREAD', 'STARRED', 'IMPORTANT',
+                    'SENT', 'DRAFT', 'CHAT', 'CATEGORY_PERSONAL', 'CATEGORY_SOCIAL',
+                    'CATEGORY_PROMOTIONS', 'CATEGORY_UPDATES', 'CATEGORY_FORUMS' ]
+
+  CATEGORIES = [ 'CATEGORY_PERSONAL', 'CATEGORY_SOCIAL', 'CATEGORY_PROMOTIONS',
+                 'CATEGORY_UPDATES', 'CATEGORY_FORUMS' ]
+
+  # history records beyond this are dropped, older history ids give 404.
+  MAX_HISTORY = 200000
+
+  def __init__ (self, seed = 42):
+    self.lock       = threading.RLock ()
+    self.rnd        = random.Random (seed)
+    self.labels     = {}
+    self.messages   = {} # id -> [ labelIds, historyId ]
+    self.order      = [] # ids, oldest first
+    self.history    = deque ()
+    self.history_id = 1
+    self.oldest     = 1
+    self.next_id    = 0x15a0000000000000
+    self.sizes      = {} # id -> body size, for messages with a fixed size
+    self.by_label   = {}
+
+    for l in self.SYSTEM_LABELS:
+      self.labels[l] = { 'id' : l, 'name' : l, 'type' : 'system' }
+
+  @classmethod
+  def synthetic (cls, n, user_labels = 20, seed = 42):
+    """
+    Generate a mailbox with `n` messages distributed over the system labels
+    and `user_labels` user labels.
+    """
+    mb = cls (seed)
+    for i in range (user_labels):
+      mb.create_label ('label-%d' % i)
+
+    users = [ l for l in mb.labels if l.startswith ('Label_') ]
+
+    for _ in range (n):
+      mb.add (mb.random_labels (users), record = False)
+
+    mb.history_id += 1
+    mb.oldest      = mb.history_id
+
+    return mb
+
+  def random_labels (self, users = None):
+    rnd    = self.rnd
+    labels = []
+
+    if rnd.random () < 0.1:
+      labels.append ('SENT')
+    elif rnd.random () < 0.3:
+      labels.append ('INBOX')
+
+    if rnd.random () < 0.2: labels.append ('UNREAD')
+    if rnd.random () < 0.02: labels.append ('STARRED')
+    if rnd.random () < 0.1: labels.append ('IMPORTANT')
+    if rnd.random () < 0.5: labels.append (rnd.choice (self.CATEGORIES))
+
+    users = users if users is not None else [ l for l in self.labels if l.startswith ('Label_') ]
+    if users and rnd.random () < 0.3:
+      labels.append (rnd.choice (users))
+
+    return labels
+
+  def __touch__ (self):
+    self.by_label.clear ()
+
+  def __record__ (self, kind, gid, labels = None):
+    self.history_id += 1
+    m = self.messages.get (gid)
+    msg = { 'id' : gid, 'threadId' : gid }
+    if m is not None:
+      msg['labelIds'] = list (m[0])
+
+    item = { 'message' : msg }
+    if labels is not None:
+      item['labelIds'] = labels
+
+    self.history.append ({ 'id' : str(self.history_id),
+                           'messages' : [ { 'id' : gid, 'threadId' : gid } ],
+                           kind : [ item ] })
+
+    while len(self.history) > self.MAX_HISTORY:
+      h = self.history.popleft ()
+      self.oldest = int(h['id'])
+
+  def add (self, labels, size = None, record = True):
+    with self.lock:
+      gid = '%016x' % self.next_id
+      self.next_id += self.rnd.randrange (1, 4096)
+
+      self.messages[gid] = [ tuple (labels), self.history_id ]
+      self.order.append (gid)
+      if size is not None:
+        self.sizes[gid] = size
+
+      if record:
+        self.__record__ ('messagesAdded', gid)
+        self.messages[gid][1] = self.history_id
+
+      self.__touch__ ()
+      return gid
+
+  def delete (self, gid):
+    with self.lock:
+      self.__record__ ('messagesDeleted', gid)
+      del self.messages[gid]
+      self.order.remove (gid)
+      self.__touch__ ()
+
+  def modify (self, gid, add, remove):
+    with self.lock:
+      m = self.messages.get (gid)
+      if m is None:
+        raise NotFound (gid)
+
+      old    = set (m[0])
+      labels = [ l for l in m[0] if l not in remove ]
+      labels.extend (l for l in add if l not in labels)
+
+      added   = [ l for l in labels if l not in old ]
+      removed = [ l for l in old if l not in labels ]
+
+      if not added and not removed:
+        return
+
+      m[0] = tuple (labels)
+      if added:
+        self.__record__ ('labelsAdded', gid, added)
+      if removed:
+        self.__record__ ('labelsRemoved', gid, removed)
+
+      m[1] = self.history_id
+      self.__touch__ ()
+
+  def create_label (self, name):
+    with self.lock:
+      for l in self.labels.values ():
+        if l['name'] == name:
+          raise ValueError ('label exists: %s' % name)
+
+      lid = 'Label_%d' % len(self.labels)
+      self.labels[lid] = { 'id' : lid, 'name' : name, 'type' : 'user' }
+      return self.labels[lid]
+
+  def raw (self, gid):
+    """ RFC822 source of the message """
+    rnd  = random.Random (gid)
+    size = self.sizes.get (gid, rnd.randrange (500, 5000))
+    line = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit %s.\r\n' % gid
+    body = line * (size // len(line) + 1)
+
+    return ('Message-ID: <%s@fakegmail.invalid>\r\n'
+            'From: Sender %d <sender%d@example.com>\r\n'
+            'To: me@example.com\r\n'
+            'Subject: Message %s\r\n'
+            'Date: Mon, 1 Jan 2018 00:00:00 +0000\r\n'
+            '\r\n' % (gid, rnd.randrange (1000), rnd.randrange (1000), gid) + body).encode ()
+
+  def message (self, gid, format = 'full', headers = None):
+    with self.lock:
+      m = self.messages.get (gid)
+      if m is None:
+        raise NotFound (gid)
+      (labels, hid) = m
+
+    raw = self.raw (gid)
+    msg = { 'id'           : gid,
+            'threadId'     : gid,
+            'labelIds'     : list (labels),
+            'historyId'    : str(hid),
+            'internalDate' : '1514764800000',
+            'sizeEstimate' : len(raw) }
+
+    if format == 'raw':
+      msg['raw'] = base64.urlsafe_b64encode (raw).decode ('ascii')
+
+    elif format != 'minimal':
+      hdrs = email.parser.BytesParser ().parsebytes (raw, headersonly = True)
+      msg['payload'] = { 'headers' : [ { 'name' : k, 'value' : v } for (k, v) in hdrs.items ()
+                                       if headers is None or k.lower () in headers ] }
+
+    return msg
+
+  def list (self, label_ids = None, page_token = None, max_results = 100):
+    with self.lock:
+      if label_ids:
+        key = tuple (sorted (label_ids))
+        ids = self.by_label.get (key)
+        if ids is None:
+          want = set (label_ids)
+          ids  = [ g for g in reversed (self.order) if want <= set (self.messages[g][0]) ]
+          self.by_label[key] = ids
+      else:
+        ids = None
+
+      start = int(page_token) if page_token else 0
+      if ids is None:
+        n     = len (self.order)
+        page  = [ self.order[n - 1 - i] for i in range (start, min (n, start + max_results)) ]
+      else:
+        n     = len (ids)
+        page  = ids[start:start + max_results]
+
+      r = { 'resultSizeEstimate' : n }
+      if page:
+        r['messages'] = [ { 'id' : g, 'threadId' : g } for g in page ]
+      if start + max_results < n:
+        r['nextPageToken'] = str(start + max_results)
+
+      return r
+
+  def history_since (self, start, page_token = None, max_results = 500):
+    with self.lock:
+      if start < self.oldest:
+        raise NotFound ('historyId %d' % start)
+
+      records = [ h for h in self.history if int(h['id']) > start ]
+      offset  = int(page_token) if page_token else 0
+
+      r = { 'historyId' : str(self.history_id) }
+      page = records[offset:offset + max_results]
+      if page:
+        r['history'] = page
+      if offset + max_results < len(records):
+        r['nextPageToken'] = str(offset + max_results)
+
+      return r
+
+def discovery_document (root):
+  """
+  Discovery document for the subset of the API implemented here
+  """
+  def p (location, type = 'string', required = False, repeated = False):
+    d = { 'type' : type, 'location' : location }
+    if required: d['required'] = True
+    if repeated: d['repeated'] = True
+    return d
+
+  user = { 'userId' : p ('path', required = True) }
+
+  def method (id, path, http, params = {}, order = [ 'userId' ], request = None, response = None):
+    m = { 'id' : 'gmail.users.' + id, 'path' : path, 'httpMethod' : http,
+          'parameters' : dict (user, **params), 'parameterOrder' : order }
+    if request:  m['request']  = { '$ref' : request }
+    if response: m['response'] = { '$ref' : response }
+    return m
+
+  schemas = [ 'Label', 'ListLabelsResponse', 'Message', 'ListMessagesResponse',
+              'ModifyMessageRequest', 'BatchModifyMessagesRequest', 'ListHistoryResponse' ]
+
+  return {
+    'kind'        : 'discovery#restDescription',
+    'discoveryVersion' : 'v1',
+    'id'          : 'gmail:v1',
+    'name'        : 'gmail',
+    'version'     : 'v1',
+    'protocol'    : 'rest',
+    'rootUrl'     : root,
+    'servicePath' : 'gmail/v1/users/',
+    'baseUrl'     : root + 'gmail/v1/users/',
+    'batchPath'   : 'batch/gmail/v1',
+    'parameters'  : { 'alt' : { 'type' : 'string', 'location' : 'query', 'default' : 'json' },
+                      'fields' : p ('query') },
+    'schemas'     : { s : { 'id' : s, 'type' : 'object' } for s in schemas },
+    'resources'   : { 'users' : { 'resources' : {
+      'labels' : { 'methods' : {
+        'list'   : method ('labels.list', '{userId}/labels', 'GET', response = 'ListLabelsResponse'),
+        'create' : method ('labels.create', '{userId}/labels', 'POST', request = 'Label', response = 'Label'),
+        } },
+      'messages' : { 'methods' : {
+        'list'   : method ('messages.list', '{userId}/messages', 'GET',
+                      { 'q' : p ('query'), 'pageToken' : p ('query'),
+                        'maxResults' : p ('query', 'integer'),
+                        'includeSpamTrash' : p ('query', 'boolean'),
+                        'labelIds' : p ('query', repeated = True) },
+                      response = 'ListMessagesResponse'),
+        'get'    : method ('messages.get', '{userId}/messages/{id}', 'GET',
+                      { 'id' : p ('path', required = True), 'format' : p ('query'),
+                        'metadataHeaders' : p ('query', repeated = True) },
+                      [ 'userId', 'id' ], response = 'Message'),
+        'modify' : method ('messages.modify', '{userId}/messages/{id}/modify', 'POST',
+                      { 'id' : p ('path', required = True) }, [ 'userId', 'id' ],
+                      request = 'ModifyMessageRequest', response = 'Message'),
+        'batchModify' : method ('messages.batchModify', '{userId}/messages/batchModify', 'POST',
+                      request = 'BatchModifyMessagesRequest'),
+        } },
+      'history' : { 'methods' : {
+        'list'   : method ('history.list', '{userId}/history', 'GET',
+                      { 'startHistoryId' : p ('query'), 'pageToken' : p ('query'),
+                        'maxResults' : p ('query', 'integer'), 'labelId' : p ('query') },
+                      response = 'ListHistoryResponse'),
+        } },
+      } } },
+  }
+
+class FakeGmail (ThreadingHTTPServer):
+  """
+  HTTP server for a Mailbox.
+
+    failures - map of HTTP status to the probability that any (sub-)request
+               fails with it, e.g. { 403 : 0.01, 500 : 0.001 }.
+  """
+
+  daemon_threads = True
+
+  def __init__ (self, address, mailbox, failures = {}, seed = 42):
+    super ().__init__ (address, Handler)
+    self.mailbox  = mailbox
+    self.failures = dict (failures)
+    self.rnd      = random.Random (seed)
+    self.requests = 0
+    self.root     = 'http://%s:%d/' % self.server_address[:2]
+
+  @property
+  def discovery_url (self):
+    return self.root + 'discovery/v1/apis/gmail/v1/rest'
+
+  def start (self):
+    t = threading.Thread (target = self.serve_forever, daemon = True)
+    t.start ()
+    return t
+
+  def __inject__ (self):
+    with self.mailbox.lock:
+      for (status, p) in self.failures.items ():
+        if self.rnd.random () < p:
+          return status
+    return None
+
+  def route (self, method, uri, body):
+    """
+    Handle one API request, returns (status, response object)
+    """
+    self.requests += 1
+    url   = urlsplit (uri)
+    path  = url.path
+    query = parse_qs (url.query)
+    q     = lambda k, d = None: query.get (k, [ d ])[0]
+    mb    = self.mailbox
+
+    if path == '/discovery/v1/apis/gmail/v1/rest':
+      return (200, discovery_document (self.root))
+
+    status = self.__inject__ ()
+    if status is not None:
+      reason = { 403 : 'rateLimitExceeded', 429 : 'rateLimitExceeded' }.get (status, 'backendError')
+      return (status, { 'error' : { 'code' : status, 'message' : 'injected error',
+                                    'errors' : [ { 'reason' : reason, 'message' : 'injected error' } ] } })
+
+    m = re.fullmatch (r'/gmail/v1/users/[^/]+/(labels|messages|history)(?:/([^/]+))?(?:/(modify))?', path)
+    if m is None:
+      return (404, { 'error' : { 'code' : 404, 'message' : 'unknown path: %s' % path } })
+
+    (resource, rid, action) = m.groups ()
+
+    try:
+      if resource == 'labels' and rid is None:
+        if method == 'GET':
+          return (200, { 'labels' : list (mb.labels.values ()) })
+        else:
+          return (200, mb.create_label (json.loads (body)['name']))
+
+      elif resource == 'history':
+        return (200, mb.history_since (int(q ('startHistoryId', 0)), q ('pageToken'),
+                                       min (500, int(q ('maxResults', 100)))))
+
+      elif resource == 'messages' and rid is None:
+        return (200, mb.list (query.get ('labelIds'), q ('pageToken'),
+                              min (500, int(q ('maxResults', 100)))))
+
+      elif resource == 'messages' and rid == 'batchModify':
+        b = json.loads (body)
+        for gid in b.get ('ids', []):
+          try:
+            mb.modify (gid, b.get ('addLabelIds', []), b.get ('removeLabelIds', []))
+          except NotFound:
+            pass
+        return (204, None)
+
+      elif resource == 'messages' and action == 'modify':
+        b = json.loads (body)
+        mb.modify (rid, b.get ('addLabelIds', []), b.get ('removeLabelIds', []))
+        return (200, mb.message (rid, 'minimal'))
+
+      elif resource == 'messages':
+        headers = query.get ('metadataHeaders')
+        if headers is not None:
+          headers = set (h.lower () for h in headers)
+        return (200, mb.message (rid, q ('format', 'full'), headers))
+
+    except NotFound as e:
+      return (404, { 'error' : { 'code' : 404, 'message' : 'Not Found: %s' % e } })
+
+    except (ValueError, KeyError) as e:
+      return (400, { 'error' : { 'code' : 400, 'message' : 'Invalid request: %s' % e } })
+
+    return (404, { 'error' : { 'code' : 404, 'message' : 'unknown request: %s %s' % (method, path) } })
+
+  def batch (self, content_type, body):
+    """
+    Handle a multipart batch request, returns (content type, body)
+    """
+    msg = email.parser.BytesParser ().parsebytes (
+        b'Content-Type: ' + content_type.encode () + b'\r\n\r\n' + body)
+
+    boundary = 'batch_' + uuid.uuid4 ().hex
+    out = []
+
+    for part in msg.get_payload ():
+      cid = part['Content-ID'].strip ('<>')
+      req = part.get_payload ().replace ('\r\n', '\n')
+      (head, _, sub_body) = req.partition ('\n\n')
+      (method, uri, _) = head.split ('\n')[0].split (' ', 2)
+
+      (status, obj) = self.route (method, uri, sub_body)
+      content = json.dumps (obj) if obj is not None else ''
+
+      out.append ('--%s\r\n'
+                  'Content-Type: application/http\r\n'
+                  'Content-ID: <response-%s>\r\n'
+                  '\r\n'
+                  'HTTP/1.1 %d %s\r\n'
+                  'Content-Type: application/json; charset=UTF-8\r\n'
+                  'Content-Length: %d\r\n'
+                  '\r\n'
+                  '%s\r\n' % (boundary, cid, status, 'OK' if status < 300 else 'Error',
+                              len(content), content))
+
+    out.append ('--%s--\r\n' % boundary)
+
+    return ('multipart/mixed; boundary=%s' % boundary, ''.join (out).encode ())
+
+class Handler (BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message (self, *args):
+    pass
+
+  def __respond__ (self, status, content_type, body):
+    self.send_response (status)
+    self.send_header ('Content-Type', content_type)
+    self.send_header ('Content-Length', str(len(body)))
+    self.end_headers ()
+    self.wfile.write (body)
+
+  def __handle__ (self, method):
+    n    = int(self.headers.get ('Content-Length', 0))
+    body = self.rfile.read (n) if n else b''
+
+    if self.path.startswith ('/batch/'):
+      (ctype, out) = self.server.batch (self.headers['Content-Type'], body)
+      self.__respond__ (200, ctype, out)
+
+    else:
+      (status, obj) = self.server.route (method, self.path, body.decode ())
+      out = json.dumps (obj).encode () if obj is not None else b''
+      self.__respond__ (status, 'application/json; charset=UTF-8', out)
+
+  def do_GET (self):
+    self.__handle__ ('GET')
+
+  def do_POST (self):
+    self.__handle__ ('POST')
+
+def parse_failures (s):
+  """ Parse '403=0.01,500=0.001' """
+  failures = {}
+  for f in filter (None, (s or '').split (',')):
+    (status, p) = f.split ('=')
+    failures[int(status)] = float(p)
+  return failures
+
+def main ():
+  parser = argparse.ArgumentParser (description = 'Local stand-in GMail API server')
+  parser.add_argument ('-p', '--port', type = int, default = 8090)
+  parser.add_argument ('-n', '--messages', type = int, default = 1000)
+  parser.add_argument ('--fail', type = str, default = '',
+      help = 'inject errors, e.g. 403=0.01,500=0.001')
+  args = parser.parse_args ()
+
+  mb = Mailbox.synthetic (args.messages)
+  server = FakeGmail (('127.0.0.1', args.port), mb, parse_failures (args.fail))
+
+  print ("serving %d messages" % args.messages)
+  print ("GMAILIEER_DISCOVERY_URL=%s" % server.discovery_url)
+  sys.stdout.flush ()
+
+  try:
+    server.serve_forever ()
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == '__main__':
+  main ()
@@ -0,0 +1,77 @@
+#! /usr/bin/env python3
+#
+# Start-up time of gmi, and a check that the heavy dependencies are not
+# imported by commands that do not need them.
+#
+# Runs `gmi -h` (and `gmi push` in REPO if given, which should have nothing
+# to push) with `python -X importtime`, reports the wall time and the slowest
+# imports, and fails if any of the heavy modules were imported.
+#
+# usage: bench/importtime.py [-n RUNS] [--repo REPO]
+#
+
+import os, sys
+import time
+import argparse
+import subprocess
+
+bench = os.path.dirname (os.path.abspath (__file__))
+gmi   = os.path.join (bench, '..', 'gmi')
+
+# must not be imported by `gmi -h` or by a `gmi push` with nothing to push
+HEAVY = [ 'googleapiclient', 'apiclient', 'oauth2client', 'httplib2', 'tqdm' ]
+
+def importtime (args, cwd = None):
+  """
+  Run gmi with -X importtime, returns (wall time, { module : cumulative us })
+  """
+  t0 = time.perf_counter ()
+  p  = subprocess.run ([ sys.executable, '-X', 'importtime', gmi ] + args, cwd = cwd,
+      stdout = subprocess.DEVNULL, stderr = subprocess.PIPE, universal_newlines = True)
+  dt = time.perf_counter () - t0
+
+  modules = {}
+  for l in p.stderr.splitlines ():
+    if not l.startswith ('import time:') or 'cumulative' in l:
+      continue
+
+    (self_us, cumulative, name) = l.split (':', 1)[1].split ('|')
+    modules[name.strip ()] = int (cumulative)
+
+  return (dt, modules)
+
+def run (what, args, n, cwd = None):
+  times = []
+  for _ in range (n):
+    (dt, modules) = importtime (args, cwd)
+    times.append (dt)
+
+  times.sort ()
+  print ("%-12s median %6.0f ms, min %6.0f ms" % (what, 1000 * times[len(times) // 2], 1000 * times[0]))
+
+  top = sorted (modules.items (), key = lambda m: -m[1])[:8]
+  for (name, us) in top:
+    print ("    %-40s %6.1f ms" % (name, us / 1000))
+
+  heavy = sorted (m for m in modules if m.split ('.')[0] in HEAVY)
+  if heavy:
+    print ("  error: heavy modules imported: %s" % ', '.join (heavy))
+
+  return len(heavy) == 0
+
+def main ():
+  parser = argparse.ArgumentParser (description = 'Start-up time of gmi')
+  parser.add_argument ('-n', '--runs', type = int, default = 10)
+  parser.add_argument ('--repo', type = str, default = None,
+      help = 'repository to time a (no-op) push in')
+  args = parser.parse_args ()
+
+  ok = run ('gmi -h', [ '-h' ], args.runs)
+
+  if args.repo is not None:
+    ok = run ('gmi push', [ 'push' ], args.runs, cwd = args.repo) and ok
+
+  sys.exit (0 if ok else 1)
+
+if __name__ == '__main__':
+  main ()
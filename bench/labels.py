@@ -0,0 +1,92 @@
+#! /usr/bin/env python3
+#
+# Micro-benchmark of translating the label ids of messages to notmuch tags,
+# as done for every message by Local.update_tags and Remote.update.
+#
+# The label ids are translated label by label (looking up the name of each
+# label, leaving out the ignored ones and translating the names to tags one
+# at the time), and with the tables compiled by LabelTranslator.compile ().
+#
+# usage: bench/labels.py [-n MESSAGES] [--labels LABELS] [--separator SEP]
+#
+
+import os, sys
+import time
+import random
+import argparse
+
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), '..'))
+
+from lieer.labels_translation import LabelTranslator
+
+SYSTEM = [ 'INBOX', 'UNREAD', 'STARRED', 'IMPORTANT', 'SENT', 'DRAFT',
+           'CATEGORY_PERSONAL', 'CATEGORY_SOCIAL', 'CATEGORY_PROMOTIONS',
+           'CATEGORY_UPDATES', 'CATEGORY_FORUMS' ]
+
+IGNORE = set ([ 'CATEGORY_PERSONAL', 'CATEGORY_SOCIAL', 'CATEGORY_PROMOTIONS',
+                'CATEGORY_UPDATES', 'CATEGORY_FORUMS' ])
+
+def messages (n, labels, rnd):
+  """
+  Label ids of `n` messages: most messages share a few combinations of
+  labels, some have less common ones.
+  """
+  common = [ rnd.sample (labels, rnd.randint (1, 4)) for _ in range (50) ]
+
+  msgs = []
+  for _ in range (n):
+    if rnd.random () < 0.9:
+      msgs.append (list (rnd.choice (common)))
+    else:
+      msgs.append (rnd.sample (labels, rnd.randint (0, 6)))
+
+  return msgs
+
+def per_label (lt, labels, glabels):
+  """ The translation of a message before the tables were compiled """
+  ls = []
+  for l in glabels:
+    ll = labels.get (l, None)
+    if ll is not None:
+      ls.append (ll)
+
+  ls = set (ls) - IGNORE
+  return set (lt.remote_labels_to_local (ls))
+
+def main ():
+  parser = argparse.ArgumentParser (description = 'Label translation')
+  parser.add_argument ('-n', '--messages', type = int, default = 1000000)
+  parser.add_argument ('--labels', type = int, default = 200,
+      help = 'user labels of the account (default: 200)')
+  parser.add_argument ('--separator', type = str, default = '.',
+      help = 'local label separator (default: .)')
+  args = parser.parse_args ()
+
+  rnd = random.Random (42)
+
+  labels = dict ((l, l) for l in SYSTEM)
+  for i in range (args.labels):
+    labels['Label_%d' % i] = 'lists/project-%d/label' % i
+
+  lt = LabelTranslator ()
+  lt.label_separator = args.separator or None
+
+  msgs = messages (args.messages, list (labels), rnd)
+
+  t0 = time.perf_counter ()
+  old = [ per_label (lt, labels, m) for m in msgs ]
+  dt_old = time.perf_counter () - t0
+
+  t0 = time.perf_counter ()
+  lt.compile (labels, IGNORE)
+  new = [ lt.label_ids_to_local (m) for m in msgs ]
+  dt_new = time.perf_counter () - t0
+
+  assert old == new, "translations differ"
+
+  print ("%d messages, %d labels" % (args.messages, len(labels)))
+  print ("  per label: %10.0f messages/s" % (args.messages / dt_old))
+  print ("  compiled:  %10.0f messages/s (%.1fx)" % (args.messages / dt_new, dt_old / dt_new))
+
+if __name__ == '__main__':
+  main ()
@@ -0,0 +1,89 @@
+#! /usr/bin/env python3
+#
+# Peak memory and throughput of writing the content of messages with large
+# attachments to the maildir, as done by Local.store for every message of a
+# full pull.
+#
+# The content of each message is received base64url encoded in the `raw`
+# field of the response. The streaming writer of Local (decoding the content
+# DECODE_CHUNK characters at the time) is compared to decoding the whole
+# message and then converting its line endings. The peak is the memory
+# allocated on top of the `raw` string itself, which is held by the response
+# anyway; it should stay flat as the messages grow.
+#
+# usage: bench/store.py [-n MESSAGES] [sizes in MB..]
+#
+
+import os, sys
+import time
+import base64
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), '..'))
+
+from lieer.local import Local
+
+def message (size):
+  """
+  A base64url encoded message with an attachment of `size` bytes, with
+  windows line endings like the messages from GMail
+  """
+  body = base64.encodebytes (os.urandom (size)).replace (b'\n', b'\r\n')
+  msg  = (b'From: bench@example.com\r\n'
+          b'To: me@example.com\r\n'
+          b'Subject: attachment\r\n'
+          b'Content-Type: application/octet-stream\r\n'
+          b'Content-Transfer-Encoding: base64\r\n'
+          b'\r\n') + body
+
+  return base64.urlsafe_b64encode (msg).decode ('ascii')
+
+def whole (raw, fd, crlf):
+  """ Decode the message in one go """
+  b = base64.urlsafe_b64decode (raw.encode ('ASCII'))
+  if not crlf:
+    b = b.replace (b'\r\n', b'\n')
+  return fd.write (b)
+
+def run (what, write, raws, d):
+  tracemalloc.start ()
+  tracemalloc.reset_peak ()
+  base = tracemalloc.get_traced_memory ()[0]
+
+  t0 = time.perf_counter ()
+  for (i, raw) in enumerate (raws):
+    with open (os.path.join (d, '%s.%d' % (what, i)), 'wb') as fd:
+      write (raw, fd, False)
+  dt = time.perf_counter () - t0
+
+  peak = tracemalloc.get_traced_memory ()[1] - base
+  tracemalloc.stop ()
+
+  return (dt, peak)
+
+def main ():
+  parser = argparse.ArgumentParser (description = 'Memory used when storing large messages')
+  parser.add_argument ('-n', '--messages', type = int, default = 5,
+      help = 'messages of each size (default: 5)')
+  parser.add_argument ('sizes', type = float, nargs = '*', default = [ 1, 5, 25 ],
+      help = 'attachment sizes in MB (default: 1 5 25)')
+  args = parser.parse_args ()
+
+  MB = 1024 * 1024
+
+  print ("%8s  %-10s %10s %12s %10s" % ('size', 'writer', 'MB/s', 'peak MB', 'peak/raw'))
+
+  for size in args.sizes:
+    raws = [ message (int (size * MB)) for _ in range (args.messages) ]
+    rawsz = len(raws[0])
+
+    with tempfile.TemporaryDirectory () as d:
+      for (what, write) in (('whole', whole), ('streaming', Local.__write_raw__)):
+        (dt, peak) = run (what, write, raws, d)
+        print ("%6.1fMB  %-10s %10.1f %12.1f %10.2f" % (size, what,
+          args.messages * rawsz / dt / MB, peak / MB, peak / rawsz))
+
+if __name__ == '__main__':
+  main ()
@@ -0,0 +1,176 @@
+#! /usr/bin/env python3
+#
+# End-to-end synchronization benchmark against the local stand-in GMail
+# server in bench/fakegmail.py.
+#
+# For every mailbox size a fresh notmuch database and gmailieer repository is
+# set up, and the following are timed with the `gmi` in this tree:
+#
+#   full pull     - initial `gmi pull` of the whole mailbox
+#   partial pull  - `gmi pull` after labels were changed, and messages added
+#                   and deleted, remotely
+#   push          - `gmi push` after tags were changed locally
+#   sync          - `gmi sync` with both local and remote changes
+#
+# requires notmuch (the command line tool and the python bindings) and the
+# google api client libraries.
+#
+# usage: bench/sync.py [-j JOBS] [--fail 403=0.01] [--changes 0.01] [sizes..]
+#
+
+import os, sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+
+bench = os.path.dirname (os.path.abspath (__file__))
+gmi   = os.path.join (bench, '..', 'gmi')
+
+sys.path.insert (0, bench)
+
+from fakegmail import Mailbox, FakeGmail, parse_failures
+
+CREDENTIALS = {
+    '_module'       : 'oauth2client.client',
+    '_class'        : 'OAuth2Credentials',
+    'access_token'  : 'fake-access-token',
+    'client_id'     : 'fake-client-id',
+    'client_secret' : 'fake-client-secret',
+    'refresh_token' : 'fake-refresh-token',
+    'token_expiry'  : '2999-01-01T00:00:00Z',
+    'token_uri'     : 'https://accounts.google.com/o/oauth2/token',
+    'user_agent'    : None,
+    'revoke_uri'    : 'https://accounts.google.com/o/oauth2/revoke',
+    'id_token'      : None,
+    'token_response': None,
+    'scopes'        : [],
+    'invalid'       : False,
+    }
+
+def notmuch_config (path, maildb):
+  with open (path, 'w') as fd:
+    fd.write ('[database]\n'
+              'path=%s\n'
+              '[user]\n'
+              'name=Bench\n'
+              'primary_email=me@example.com\n'
+              '[new]\n'
+              'tags=new\n'
+              'ignore=.gmailieer.json;.gmailieer.json.bak;.gmailieer.journal.json;.gmailieer.db;.gmailieer.db-wal;.gmailieer.db-shm;.credentials.gmailieer.json;.gmailieer.sock;.lock\n'
+              '[maildir]\n'
+              'synchronize_flags=true\n' % maildb)
+
+class Account:
+  def __init__ (self, tmp, server, jobs):
+    self.maildb = os.path.join (tmp, 'mail')
+    self.repo   = os.path.join (self.maildb, 'account')
+    self.jobs   = jobs
+
+    os.makedirs (self.repo)
+
+    self.env = dict (os.environ)
+    self.env['NOTMUCH_CONFIG'] = os.path.join (tmp, 'notmuch-config')
+    self.env['GMAILIEER_DISCOVERY_URL'] = server.discovery_url
+    notmuch_config (self.env['NOTMUCH_CONFIG'], self.maildb)
+
+    self.notmuch ('new', '--quiet')
+    self.gmi ('init', '--no-auth', 'me@example.com')
+
+    with open (os.path.join (self.repo, '.credentials.gmailieer.json'), 'w') as fd:
+      json.dump (CREDENTIALS, fd)
+
+  def notmuch (self, *args, input = None):
+    return subprocess.run (('notmuch',) + args, env = self.env, cwd = self.repo,
+        input = input, check = True, stdout = subprocess.PIPE,
+        universal_newlines = True).stdout
+
+  def gmi (self, *args):
+    subprocess.run ((sys.executable, gmi) + args, env = self.env, cwd = self.repo,
+        check = True, stdout = subprocess.DEVNULL)
+
+  def timed (self, *args):
+    t0 = time.perf_counter ()
+    if args[0] in ('pull', 'sync') and self.jobs > 1:
+      args = args + ('-j', str(self.jobs))
+    self.gmi (*args)
+    return time.perf_counter () - t0
+
+  def tag_random (self, k, rnd):
+    """ toggle a tag on `k` random local messages """
+    ids = self.notmuch ('search', '--output=messages', 'path:account/**').split ()
+    lines = [ '%s -- %s\n' % (rnd.choice (('+bench', '+flagged', '-unread')), i)
+              for i in rnd.sample (ids, min (k, len(ids))) ]
+    self.notmuch ('tag', '--batch', input = ''.join (lines))
+
+def change_remote (mb, k, rnd):
+  """ relabel `k` messages, and add and delete a tenth as many """
+  with mb.lock:
+    gids = rnd.sample (mb.order, min (k, len(mb.order)))
+
+  for gid in gids:
+    if rnd.random () < 0.5:
+      mb.modify (gid, [ 'STARRED' ], [])
+    else:
+      mb.modify (gid, [], [ 'UNREAD', 'INBOX' ])
+
+  for gid in gids[:k // 10]:
+    mb.delete (gid)
+
+  for _ in range (k // 10):
+    mb.add (mb.random_labels ())
+
+def run (n, args):
+  rnd     = random.Random (42)
+  changes = max (1, int(n * args.changes))
+
+  t0 = time.perf_counter ()
+  mb = Mailbox.synthetic (n)
+  server = FakeGmail (('127.0.0.1', 0), mb, parse_failures (args.fail))
+  server.start ()
+  print ("%d messages: generated in %.1f s" % (n, time.perf_counter () - t0))
+
+  results = []
+  try:
+    with tempfile.TemporaryDirectory () as tmp:
+      account = Account (tmp, server, args.jobs)
+
+      results.append (('full pull', account.timed ('pull')))
+
+      change_remote (mb, changes, rnd)
+      results.append (('partial pull', account.timed ('pull')))
+
+      account.tag_random (changes, rnd)
+      results.append (('push', account.timed ('push')))
+
+      change_remote (mb, changes, rnd)
+      account.tag_random (changes, rnd)
+      results.append (('sync', account.timed ('sync')))
+
+  finally:
+    server.shutdown ()
+    server.server_close ()
+
+  for (what, dt) in results:
+    print ("  %-14s %8.2f s" % (what, dt))
+  print ("  %-14s %8d" % ('api requests', server.requests))
+
+  return results
+
+def main ():
+  parser = argparse.ArgumentParser (description = 'End-to-end synchronization benchmark')
+  parser.add_argument ('sizes', type = int, nargs = '*', default = [ 1000, 100000, 1000000 ])
+  parser.add_argument ('-j', '--jobs', type = int, default = 1)
+  parser.add_argument ('--changes', type = float, default = 0.01,
+      help = 'fraction of the mailbox changed between runs (default: 0.01)')
+  parser.add_argument ('--fail', type = str, default = '',
+      help = 'inject errors, e.g. 403=0.01,500=0.001')
+  args = parser.parse_args ()
+
+  for n in args.sizes:
+    run (n, args)
+
+if __name__ == '__main__':
+  main ()
@@ -0,0 +1,63 @@
+#! /usr/bin/env python3
+#
+# Measures the throughput of the cache maintenance done by Local.update_tags
+# for a message whose maildir flags changed: looking up the file name of the
+# gid and moving the cache entry to the renamed file.
+#
+# usage: bench/update_tags.py [sizes..]
+#
+
+import os, sys
+import random
+import tempfile
+import time
+import types
+
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), '..'))
+
+from lieer.local import Local
+from lieer.stats import Stats
+
+class Message:
+  """ Stand-in for the parts of NotmuchMessage used by the cache """
+  def __init__ (self, fname):
+    self.fname = fname
+
+  def get_filenames (self):
+    return [ self.fname ]
+
+def run (n, updates = 50000):
+  with tempfile.TemporaryDirectory () as wd:
+    os.chdir (wd)
+    for d in ('cur', 'new', 'tmp'):
+      os.makedirs (os.path.join ('mail', d))
+
+    local = Local (types.SimpleNamespace (dry_run = False, stats = Stats ()))
+    gids  = [ '%016x' % i for i in range (n) ]
+
+    for gid in gids:
+      local.index.add (gid, 'cur/%s:2,S' % gid)
+    local.index.commit ()
+
+    rnd = random.Random (42)
+    sample = [ rnd.choice (gids) for _ in range (updates) ]
+
+    t0 = time.perf_counter ()
+    for gid in sample:
+      old = os.path.join (local.md, local.index[gid])
+      new = old[:-1] if old.endswith ('S') else old + 'S'
+      local.__update_cache__ (Message (new), (gid, old))
+    local.index.commit ()
+    dt = time.perf_counter () - t0
+
+    os.chdir ('/')
+
+  print ("%9d cached files: %8.0f updates/s" % (n, updates / dt))
+
+def main ():
+  sizes = [ int(a) for a in sys.argv[1:] ] or [ 10000, 100000, 1000000 ]
+  for n in sizes:
+    run (n)
+
+if __name__ == '__main__':
+  main ()
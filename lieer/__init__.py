@@ -1,2 +1,16 @@
 from .gmailieer import *
 
+def __getattr__ (name):
+  """
+  Remote (and the google api client libraries) and Daemon are only imported
+  when used.
+  """
+  if name == 'Remote':
+    from .remote import Remote
+    return Remote
+
+  elif name == 'Daemon':
+    from .daemon import Daemon
+    return Daemon
+
+  raise AttributeError ("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,108 @@
+from collections import OrderedDict
+
+class ChangeSet:
+  """
+  Resolves a sequence of history records into the messages that need to be
+  added, deleted or have their labels updated locally.
+
+  Each message id occurs in at most one of the sets, and only with the most
+  recent message object seen for it. Every record is resolved with a
+  constant number of dictionary operations, so replaying the history is
+  linear in its length.
+  """
+
+  def __init__ (self, has, not_sync):
+    """
+      has      - function telling whether a message id exists locally
+      not_sync - labels of messages that should not be synchronized
+    """
+    self.has      = has
+    self.not_sync = not_sync
+
+    # added messages, if they are later deleted they will be removed from
+    # this set.
+    self.added    = OrderedDict ()
+
+    # deleted messages, if they are later added they will be removed from
+    # this set.
+    self.deleted  = OrderedDict ()
+
+    # messages which have had their labels changed, the entry will be the
+    # last and most recent one in case of multiple changes. if the message is
+    # either deleted or added after the label change it will be removed from
+    # this set.
+    self.labels_changed = OrderedDict ()
+
+  @property
+  def added_messages (self):
+    return list (self.added.values ())
+
+  @property
+  def deleted_messages (self):
+    return list (self.deleted.values ())
+
+  @property
+  def changed_messages (self):
+    return list (self.labels_changed.values ())
+
+  def __remove_from_all__ (self, m):
+    self.deleted.pop (m['id'], None)
+    self.labels_changed.pop (m['id'], None)
+    self.added.pop (m['id'], None)
+
+  def __is_synced__ (self, m):
+    return not (set(m.get('labelIds', [])) & self.not_sync)
+
+  def __labels_changed__ (self, m):
+    gid = m['id']
+
+    if self.__is_synced__ (m):
+      new = self.added.pop (gid, None) is not None or not self.has (gid)
+      self.labels_changed.pop (gid, None)
+      if new:
+        self.added[gid] = m # needs to fetched
+      else:
+        self.labels_changed[gid] = m
+    else:
+      # in case a not_sync tag has been added to a scheduled message
+      self.added.pop (gid, None)
+      self.labels_changed.pop (gid, None)
+
+      if self.has (gid):
+        self.deleted.pop (gid, None)
+        self.deleted[gid] = m
+
+  def apply (self, h):
+    """
+    Apply a single history record
+
+    The message objects in history records have no historyId, they are given
+    the id of the record.
+    """
+    if 'messagesAdded' in h:
+      for m in h['messagesAdded']:
+        mm = m['message']
+        mm.setdefault ('historyId', h['id'])
+        if self.__is_synced__ (mm):
+          self.__remove_from_all__ (mm)
+          self.added[mm['id']] = mm
+
+    if 'messagesDeleted' in h:
+      for m in h['messagesDeleted']:
+        mm = m['message']
+        # might silently fail to delete this
+        self.__remove_from_all__ (mm)
+        if self.has (mm['id']):
+          self.deleted[mm['id']] = mm
+
+    # messages that are subsequently deleted by a later action will be removed
+    # from either labels_changed or added.
+    if 'labelsAdded' in h:
+      for m in h['labelsAdded']:
+        m['message'].setdefault ('historyId', h['id'])
+        self.__labels_changed__ (m['message'])
+
+    if 'labelsRemoved' in h:
+      for m in h['labelsRemoved']:
+        m['message'].setdefault ('historyId', h['id'])
+        self.__labels_changed__ (m['message'])
@@ -0,0 +1,232 @@
+import os
+import json
+import time
+import socket
+import threading
+import socketserver
+
+import notmuch
+
+class Daemon:
+  """
+  Keeps a repository synchronized: the remote is polled for changes on an
+  adaptive interval, and local changes are pushed as they appear.
+
+  The remote is polled (push followed by pull, like `sync`) every `interval`
+  seconds. The interval starts at `min_interval`, it grows by GROWTH after
+  every poll that found nothing new up to `max_interval`, and drops back to
+  `min_interval` when something changed. The notmuch database is checked
+  every LOCAL_INTERVAL seconds, and local changes (the revision has moved
+  past the lastmod of the last push) are pushed right away.
+
+  The authorized Remote with its connections and label map, and the Local
+  caches, are kept between synchronizations.
+
+  The daemon is controlled through a UNIX socket in the repository, with one
+  command per connection:
+
+    sync-now  - synchronize right away
+    status    - get the state of the daemon
+    stop      - stop after the current synchronization
+
+  Replies are JSON objects.
+  """
+
+  LOCAL_INTERVAL = 5
+  GROWTH         = 1.5
+
+  class DaemonException (Exception):
+    pass
+
+  class Handler (socketserver.StreamRequestHandler):
+    def handle (self):
+      cmd   = self.rfile.readline ().decode ('utf-8').strip ()
+      reply = self.server.daemon.command (cmd)
+      self.wfile.write ((json.dumps (reply) + '\n').encode ('utf-8'))
+
+  class Server (socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+  def __init__ (self, g, args):
+    self.gmailieer    = g
+    self.args         = args
+    self.min_interval = args.interval
+    self.max_interval = max (args.interval, args.max_interval)
+    self.interval     = self.min_interval
+    self.next_poll    = time.monotonic ()
+    self.socket_f     = Daemon.socket_path (g.local.wd)
+    self.server       = None
+
+    self.lock     = threading.Lock ()
+    self.wakeup   = threading.Event ()
+    self.stopping = False
+    self.sync_now = False
+
+    self.status   = { 'state'      : 'starting',
+                      'syncs'      : 0,
+                      'pushes'     : 0,
+                      'errors'     : 0,
+                      'last_sync'  : None,
+                      'last_error' : None }
+
+  @staticmethod
+  def socket_path (wd):
+    return os.path.join (wd, '.gmailieer.sock')
+
+  @staticmethod
+  def send (path, cmd):
+    """
+    Send a command to the daemon listening on `path`, returns the reply
+    """
+    s = socket.socket (socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      s.connect (path)
+      s.sendall ((cmd + '\n').encode ('utf-8'))
+      with s.makefile ('rb') as f:
+        return json.loads (f.readline ().decode ('utf-8'))
+    finally:
+      s.close ()
+
+  def command (self, cmd):
+    """
+    Handle a command from the control socket (called from the server threads)
+    """
+    with self.lock:
+      if cmd == 'sync-now':
+        self.sync_now = True
+        self.wakeup.set ()
+        return { 'ok' : True }
+
+      elif cmd == 'stop':
+        self.stopping = True
+        self.wakeup.set ()
+        return { 'ok' : True }
+
+      elif cmd == 'status':
+        status = dict (self.status)
+        status['ok']        = True
+        status['account']   = self.gmailieer.local.state.account
+        status['historyId'] = self.gmailieer.local.state.last_historyId
+        status['lastmod']   = self.gmailieer.local.state.lastmod
+        status['interval']  = self.interval
+        status['next_poll'] = max (0, self.next_poll - time.monotonic ())
+        return status
+
+      else:
+        return { 'ok' : False, 'error' : 'unknown command: %s' % cmd }
+
+  def __set__ (self, **kwargs):
+    with self.lock:
+      self.status.update (kwargs)
+
+  def __listen__ (self):
+    if os.path.exists (self.socket_f):
+      try:
+        Daemon.send (self.socket_f, 'status')
+      except OSError:
+        # left behind by a daemon that did not exit cleanly
+        os.unlink (self.socket_f)
+      else:
+        raise Daemon.DaemonException ("a daemon is already running for this repository: %s" % self.socket_f)
+
+    self.server = Daemon.Server (self.socket_f, Daemon.Handler)
+    self.server.daemon = self
+    os.chmod (self.socket_f, 0o600)
+
+    t = threading.Thread (target = self.server.serve_forever, daemon = True)
+    t.start ()
+
+  def __local_changed__ (self):
+    with notmuch.Database () as db:
+      (rev, uuid) = db.get_revision ()
+
+    return rev != self.gmailieer.local.state.lastmod
+
+  def __sync__ (self, pull):
+    """
+    Push local changes, and pull remote changes if `pull`.
+
+    Returns True if the remote has changed.
+    """
+    g   = self.gmailieer
+    hid = g.local.state.last_historyId
+
+    self.__set__ (state = 'syncing' if pull else 'pushing')
+    g.stats.reset ()
+
+    try:
+      # notmuch may have renamed files when synchronizing maildir flags
+      g.local.index.check ()
+
+      g.remote.all_updated = True
+      g.push (self.args, True)
+
+      if not pull and not g.remote.all_updated:
+        # messages that changed remotely were not pushed (and lastmod was not
+        # moved on), pull the changes right away rather than pushing the same
+        # changes again until the next poll.
+        with self.lock:
+          self.next_poll = time.monotonic ()
+
+      if pull:
+        g.pull (self.args, True)
+
+      g.stats.finish ()
+
+    except Exception as e:
+      print ("daemon: synchronization failed: %s: %s" % (type(e).__name__, e))
+      g.stats.finish ('%s: %s' % (type(e).__name__, e))
+
+      with self.lock:
+        self.status['errors']    += 1
+        self.status['last_error'] = '%s: %s' % (type(e).__name__, e)
+
+    g.write_stats (self.args)
+
+    with self.lock:
+      self.status['pushes'] += 1
+      if pull:
+        self.status['syncs']    += 1
+        self.status['last_sync'] = time.time ()
+      self.status['state'] = 'idle'
+
+    return g.local.state.last_historyId != hid
+
+  def run (self):
+    self.__listen__ ()
+    print ("daemon: listening on %s" % self.socket_f)
+
+    try:
+      while True:
+        self.wakeup.clear ()
+
+        with self.lock:
+          if self.stopping:
+            break
+
+          sync_now      = self.sync_now
+          self.sync_now = False
+
+        if sync_now or time.monotonic () >= self.next_poll:
+          if self.__sync__ (True):
+            self.interval = self.min_interval
+          else:
+            self.interval = min (self.max_interval, self.interval * self.GROWTH)
+
+          with self.lock:
+            self.next_poll = time.monotonic () + self.interval
+
+        elif self.__local_changed__ ():
+          self.__sync__ (False)
+
+        self.wakeup.wait (max (0, min (self.LOCAL_INTERVAL, self.next_poll - time.monotonic ())))
+
+    except KeyboardInterrupt:
+      pass
+
+    finally:
+      print ("daemon: stopping..")
+      self.server.shutdown ()
+      self.server.server_close ()
+      if os.path.exists (self.socket_f):
+        os.unlink (self.socket_f)
@@ -5,27 +5,109 @@
 
 import  os, sys
 import  argparse
-from    oauth2client import tools
-import  googleapiclient
-import  notmuch
+from    array import array
+from    bisect import bisect_left
+from    collections import OrderedDict
 
-from tqdm import tqdm, tqdm_gui
-
-from .remote import *
 from .local  import *
 from .labels_translation import LabelTranslator
+from .changeset import ChangeSet
+from .stats import Stats
+
+# the google api client libraries (through .remote), notmuch and tqdm are slow
+# to import. they are only imported by the commands that use them, so that
+# e.g. `gmi -h`, `gmi set` or a `gmi push` with nothing to push start quickly.
+
+def tqdm (*args, **kwargs):
+  """
+  Progress bar, tqdm is imported on first use
+  """
+  from tqdm import tqdm as _tqdm
+  return _tqdm (*args, **kwargs)
+
+def oauth_argparser ():
+  """
+  The flags of oauth2client.tools.argparser, which are used by
+  tools.run_flow () when authorizing. Replicated here so that oauth2client
+  does not have to be imported to set up the command line.
+  """
+  parser = argparse.ArgumentParser (add_help = False)
+  parser.add_argument ('--auth_host_name', default = 'localhost',
+      help = 'Hostname when running a local web server.')
+  parser.add_argument ('--noauth_local_webserver', action = 'store_true',
+      default = False, help = 'Do not run a local web server.')
+  parser.add_argument ('--auth_host_port', default = [8080, 8090], type = int,
+      nargs = '*', help = 'Port web server should listen on.')
+  parser.add_argument ('--logging_level', default = 'ERROR',
+      choices = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+      help = 'Set the logging level of detail.')
+
+  return parser
 
 class Gmailieer:
 
   user_label_trans_file_name = '.label-trans.json'
-  
-  def __init__ (self):
+
+  # number of message ids from the listing in a full pull that are collected
+  # before they are fetched, the progress is checkpointed after each chunk.
+  FULL_PULL_CHUNK = 1000
+
+  # number of changed messages that are pushed at the time, the remote
+  # metadata of all messages in a chunk is fetched before the changes are
+  # pushed.
+  PUSH_CHUNK = 500
+
+  # the tags of the messages that are already stored are brought up to date in
+  # a full pull by listing the messages of each label (see reconcile ()),
+  # rather than by getting the metadata of each message. listing takes about
+  # a request per label, plus a request per LIST_PAGE_SIZE messages of each
+  # label: estimated as this many messages of the mailbox per request.
+  RECONCILE_MESSAGES_PER_REQUEST = 100
+
+  # set up by sync-all for the accounts synchronized at once: the semaphore
+  # limiting the concurrent requests of all accounts, and the notmuch database
+  # their writes go through. progress bars are not shown for these.
+  budget    = None
+  shared_db = None
+  progress  = True
+
+  # adopt messages that are already in notmuch (see adopt_messages ())
+  adopt     = False
+
+  # the parsed command line, and whether the authorization flow may be run
+  # when there are no valid credentials (not for the accounts of sync-all).
+  args        = None
+  interactive = True
+
+  def __init__ (self, wd = None):
+    # the repository, defaults to the current directory
+    self.wd = wd
+
     xdg_data_home = os.getenv ('XDG_DATA_HOME', os.path.expanduser ('~/.local/share'))
     self.home = os.path.join (xdg_data_home, 'gmailieer')
 
     # the sole instance of LableTranslator
     self._label_translator = LabelTranslator()
 
+    # timings and counters of this run
+    self.stats = Stats ()
+
+    self._remote = None
+
+  @property
+  def remote (self):
+    """
+    The Remote of the loaded repository, created on first use
+    """
+    if self._remote is None:
+      from .remote import Remote
+      self._remote = Remote (self)
+
+    return self._remote
+
+  def tqdm (self, *args, **kwargs):
+    return tqdm (*args, disable = not self.progress, **kwargs)
+
   @property
   def label_translator(self):
     return self._label_translator
@@ -59,13 +141,19 @@ class Gmailieer:
                                      description="Sync email between GMail and Notmuch database",
                                      epilog="To get help on a specific command use the following:"
                                      " %(prog)s <command> -h",
-                                     parents=[tools.argparser])
+                                     parents=[oauth_argparser ()])
     self.parser = parser
 
     common = argparse.ArgumentParser (add_help = False)
     common.add_argument ('-c', '--credentials', type = str, default = None,
         help = 'optional credentials file for google api')
 
+    common.add_argument ('--stats-file', type = str, default = None,
+        help = 'write timings and counters of the run to this file as JSON')
+
+    common.add_argument ('--prometheus-file', type = str, default = None,
+        help = 'write timings and counters of the run to this file in the Prometheus text format (for the node_exporter textfile collector)')
+
     subparsers = parser.add_subparsers (help = 'actions', dest = 'action')
     subparsers.required = True
 
@@ -92,6 +180,12 @@ class Gmailieer:
     parser_pull.add_argument ('-r', '--remove', action = 'store_true',
         default = False, help = 'Remove files locally when they have been deleted remotely (forces full sync)')
 
+    parser_pull.add_argument ('-j', '--jobs', type = int, default = 1,
+        help = 'Number of concurrent batch requests when fetching messages (default: 1)')
+
+    parser_pull.add_argument ('--adopt', action = 'store_true', default = False,
+        help = 'Use the files of messages that are already in notmuch (matched by Message-ID), e.g. from another synchronization tool, rather than downloading them')
+
     parser_pull.set_defaults (func = self.pull)
 
     # push
@@ -127,8 +221,68 @@ class Gmailieer:
     parser_sync.add_argument ('-r', '--remove', action = 'store_true',
         default = False, help = 'Remove files locally when they have been deleted remotely (forces full sync)')
 
+    parser_sync.add_argument ('-j', '--jobs', type = int, default = 1,
+        help = 'Number of concurrent batch requests when fetching messages (default: 1)')
+
     parser_sync.set_defaults (func = self.sync)
 
+    # daemon
+    parser_daemon = subparsers.add_parser ('daemon', parents = [common],
+        description = 'daemon',
+        help = 'keep synchronizing: poll for remote changes and push local changes as they appear')
+
+    parser_daemon.add_argument ('-i', '--interval', type = float, default = 30,
+        help = 'Seconds between polling for remote changes while there is activity (default: 30)')
+
+    parser_daemon.add_argument ('--max-interval', type = float, default = 600,
+        help = 'Maximum seconds between polling for remote changes when there is no activity (default: 600)')
+
+    parser_daemon.add_argument ('-j', '--jobs', type = int, default = 1,
+        help = 'Number of concurrent batch requests when fetching messages (default: 1)')
+
+    parser_daemon.set_defaults (func = self.daemon, remove = False)
+
+    # ctl
+    parser_ctl = subparsers.add_parser ('ctl',
+        description = 'control daemon',
+        help = 'control the daemon running for this repository')
+
+    parser_ctl.add_argument ('command', choices = [ 'sync-now', 'status', 'stop' ],
+        help = 'sync-now: synchronize right away, status: show state of daemon, stop: stop daemon')
+
+    parser_ctl.set_defaults (func = self.ctl)
+
+    # sync-all
+    parser_sync_all = subparsers.add_parser ('sync-all', parents = [common],
+        description = 'sync-all',
+        help = 'sync several repositories (accounts) at once')
+
+    parser_sync_all.add_argument ('repositories', nargs = '+', type = str,
+        help = 'the repositories to synchronize')
+
+    parser_sync_all.add_argument ('--limit', type = int, default = None,
+        help = 'Maximum number of messages to sync in each repository')
+
+    parser_sync_all.add_argument ('-d', '--dry-run', action='store_true',
+        default = False, help = 'do not make any changes')
+
+    parser_sync_all.add_argument ('-f', '--force', action = 'store_true',
+        default = False, help = 'Push even when there has been remote changes, and force a full remote-to-local synchronization')
+
+    parser_sync_all.add_argument ('-r', '--remove', action = 'store_true',
+        default = False, help = 'Remove files locally when they have been deleted remotely (forces full sync)')
+
+    parser_sync_all.add_argument ('-j', '--jobs', type = int, default = 1,
+        help = 'Number of concurrent batch requests when fetching messages, for each repository (default: 1)')
+
+    parser_sync_all.add_argument ('-p', '--parallel', type = int, default = 4,
+        help = 'Number of repositories synchronized at once (default: 4)')
+
+    parser_sync_all.add_argument ('--max-requests', type = int, default = 4,
+        help = 'Maximum number of concurrent requests over all repositories (default: 4)')
+
+    parser_sync_all.set_defaults (func = self.sync_all)
+
     # auth
     parser_auth = subparsers.add_parser ('auth', parents = [common],
         description = 'authorize',
@@ -156,6 +310,9 @@ class Gmailieer:
     parser_init.add_argument('--user-label-translation', action='store_true',
                              help=user_label_translatien_help)                             
 
+    parser_init.add_argument ('--adopt', action = 'store_true', default = False,
+        help = 'Use the files of messages that are already in notmuch (matched by Message-ID), e.g. from another synchronization tool, rather than downloading them in the initial pull')
+
     parser_init.set_defaults (func = self.initialize)
 
 
@@ -172,6 +329,12 @@ class Gmailieer:
 
     parser_set.add_argument ('--no-drop-non-existing-labels', action = 'store_true', default = False)
 
+    parser_set.add_argument ('--write-batch', type = int, default = None,
+        help = 'Set number of messages written to notmuch in each transaction (default: %d)' % Local.State.write_batch)
+
+    parser_set.add_argument ('--durability', choices = Local.DURABILITY, default = None,
+        help = 'Set when message files are flushed to disk: none (left to the system), batch (together, before the state is advanced) or file (every file as it is written) (default: %s)' % Local.State.durability)
+
     group_set = parser_set.add_mutually_exclusive_group()
     group_set.add_argument("--user-label-translation", action="store_true",
                        help=user_label_translatien_help)
@@ -199,18 +362,43 @@ class Gmailieer:
     
     args        = parser.parse_args (sys.argv[1:])
     self.args   = args
-    args.func (args)
+
+    self.stats.action = args.action
+    try:
+      args.func (args)
+      self.stats.finish ()
+
+    except BaseException as e:
+      self.stats.finish ('%s: %s' % (type(e).__name__, e))
+      raise
+
+    finally:
+      self.write_stats (args)
+
+  def write_stats (self, args):
+    stats_file      = getattr (args, 'stats_file', None)
+    prometheus_file = getattr (args, 'prometheus_file', None)
+
+    try:
+      if stats_file is not None:
+        self.stats.write_json (stats_file)
+
+      if prometheus_file is not None:
+        self.stats.write_prometheus (prometheus_file)
+
+    except OSError as e:
+      print ("stats: could not write statistics:", e)
 
 
     
   def initialize (self, args):
     self.setup (args, False)
     self.local.initialize_repository(args.account,
-                                     args.user_label_translation)
+                                     args.user_label_translation,
+                                     args.adopt)
 
     if not args.no_auth:
       self.local.load_repository ()
-      self.remote = Remote (self)
 
       try:
         self.remote.authorize ()
@@ -237,14 +425,16 @@ class Gmailieer:
     if self.dry_run:
       print ("dry-run: ", self.dry_run)
 
-    self.local  = Local (self)
+    self.local  = Local (self, self.wd)
+    self._remote = None
     if load:
       self.local.load_repository ()
-      self.remote = Remote (self)
+      self.writer = Local.Writer (self.local, self.local.state.write_batch, self.shared_db)
+      self.stats.account = self.local.state.account
 
       if self.local.state.user_label_translation:
         try:
-          map_file = Gmailieer.user_label_trans_file_name
+          map_file = os.path.join (self.local.wd, Gmailieer.user_label_trans_file_name)
           self.label_translator.load_user_translation(map_file)
           print("User's label translation loaded (file: {})".format(map_file))
         # except json.decoder.JSONDecodeError as e:
@@ -260,6 +450,7 @@ class Gmailieer:
     self.force            = args.force
     self.limit            = args.limit
     self.list_labels      = False
+    self.remote.jobs      = args.jobs
 
     self.remote.get_labels ()
 
@@ -271,15 +462,122 @@ class Gmailieer:
     # resolving any conflicts.
     self.pull (args, True)
 
+  def sync_all (self, args):
+    """
+    Synchronize each of the repositories like `sync`, several at the time.
+
+    The requests of all the accounts share one budget of concurrent requests,
+    and the changes to notmuch of all the accounts go through one database
+    opened for writing (the repositories may share the notmuch database, the
+    writers would otherwise be waiting for each other to release the lock).
+    """
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from oauth2client.client import HttpAccessTokenRefreshError
+    from .remote import Remote
+
+    budget    = threading.BoundedSemaphore (max (1, args.max_requests))
+    shared_db = Local.SharedDatabase ()
+
+    def _sync (repo):
+      g = Gmailieer (repo)
+      g.args        = args
+      g.interactive = False
+      g.budget      = budget
+      g.shared_db   = shared_db
+      g.progress    = False
+      g.stats.action = 'sync'
+
+      # the authorization flow cannot be run for several accounts at once
+      reauth = "no valid credentials, run `gmi auth` in %s" % os.path.abspath (repo)
+
+      if not Remote.valid_credentials (os.path.join (repo, '.credentials.gmailieer.json')):
+        print ("sync-all: %s: %s" % (repo, reauth))
+        g.stats.finish (reauth)
+        return g
+
+      try:
+        g.sync (args)
+        g.stats.finish ()
+
+      except HttpAccessTokenRefreshError as e:
+        print ("sync-all: %s: %s (%s)" % (repo, reauth, e))
+        g.stats.finish (reauth)
+
+      except Exception as e:
+        print ("sync-all: %s: failed: %s: %s" % (repo, type(e).__name__, e))
+        g.stats.finish ('%s: %s' % (type(e).__name__, e))
+
+      return g
+
+    print ("sync-all: synchronizing %d repositories.." % len(args.repositories))
+
+    with ThreadPoolExecutor (max_workers = max (1, args.parallel)) as pool:
+      results = list (pool.map (_sync, args.repositories))
+
+    print ("")
+    print ("%-40s %-7s %9s %8s %8s %9s" % ('account', 'result', 'duration', 'stored', 'pushed', 'requests'))
+
+    failed = 0
+    for (repo, g) in zip (args.repositories, results):
+      s = g.stats.summary ()
+      c = s['counters']
+      print ("%-40s %-7s %8.1fs %8d %8d %9d" % (s['account'] or repo,
+        'ok' if s['success'] else 'error', s['duration'],
+        c.get ('messages_stored', 0), c.get ('messages_pushed', 0),
+        c.get ('requests', 0)))
+
+      if not s['success']:
+        failed += 1
+        print ("  %s" % s['error'])
+
+      self.stats.merge (g.stats)
+
+    if failed:
+      print ("sync-all: %d of %d repositories failed" % (failed, len(results)))
+      sys.exit (1)
+
+  def daemon (self, args):
+    self.setup (args, False, True)
+
+    self.force            = False
+    self.limit            = None
+    self.list_labels      = False
+    self.remote.jobs      = args.jobs
+
+    self.remote.get_labels ()
+
+    from .daemon import Daemon
+    Daemon (self, args).run ()
+
+  def ctl (self, args):
+    from .daemon import Daemon
+    path = Daemon.socket_path (os.getcwd ())
+
+    try:
+      reply = Daemon.send (path, args.command)
+    except OSError as e:
+      print ("ctl: could not connect to daemon at %s: %s" % (path, e))
+      sys.exit (1)
+
+    if not reply.get ('ok', False):
+      print ("ctl: error: %s" % reply.get ('error'))
+      sys.exit (1)
+
+    if args.command == 'status':
+      for k in sorted (reply):
+        if k != 'ok':
+          print ("%-12s: %s" % (k, reply[k]))
+
   def push (self, args, setup = False):
+    import notmuch
+
     if not setup:
       self.setup (args, args.dry_run, True)
 
       self.force            = args.force
       self.limit            = args.limit
 
-      self.remote.get_labels ()
-
     # loading local changes
     with notmuch.Database () as db:
       (rev, uuid) = db.get_revision ()
@@ -288,63 +586,129 @@ class Gmailieer:
         print ("push: everything is up-to-date.")
         return
 
+      from googleapiclient.errors import HttpError
+      from .remote import Remote
+
+      if not setup:
+        self.remote.get_labels ()
+
       qry = "path:%s/** and lastmod:%d..%d" % (self.local.nm_relative, self.local.state.lastmod, rev)
 
       # print ("collecting changes..: %s" % qry)
       query = notmuch.Query (db, qry)
-      total = query.count_messages () # probably destructive here as well
-      query = notmuch.Query (db, qry)
+      messages = query.search_messages ()
+
+      # the changed messages are streamed through the pipeline in chunks:
+      # the remote metadata of a chunk is fetched and its changes pushed
+      # before the next chunk is read from notmuch, so that only one chunk is
+      # kept in memory and the first changes are pushed right away.
+      chunk   = OrderedDict () # gid -> NotmuchMessage
+      pushed  = 0
+      changed = 0
+      n       = 0
+
+      # the messages that have changed remotely since the last pull. the
+      # other messages are diffed against the labels they had when they were
+      # last pulled or pushed, and their metadata does not need to be fetched.
+      remote_changed = None
+      if self.local.state.last_historyId > 0:
+        try:
+          with self.stats.phase ('push.history'):
+            remote_changed = self.remote.get_changed_since (self.local.state.last_historyId)
 
-      messages = list(query.search_messages ())
-      if self.limit is not None and len(messages) > self.limit:
-        messages = messages[:self.limit]
+        except (HttpError, Remote.NoHistoryException):
+          print ("push: could not get remote changes, fetching metadata of all changed messages.")
 
-      # get gids and filter out messages outside this repository
-      messages, gids = self.local.messages_to_gids (messages)
+      meta_bar = self.tqdm (leave = True, desc = 'receiving metadata')
+      push_bar = self.tqdm (leave = True, total = 0, desc = 'pushing, 0 changed')
 
-      # get meta-data on changed messages from remote
-      remote_messages = []
-      bar = tqdm (leave = True, total = len(gids), desc = 'receiving metadata')
+      def _push_chunk ():
+        nonlocal pushed
 
-      def _got_msgs (ms):
-        for m in ms:
-          bar.update (1)
-          remote_messages.append (m)
+        actions = []
 
-      self.remote.get_messages (gids, _got_msgs, 'minimal')
-      bar.close ()
+        def _update (m):
+          meta_bar.update (1)
+          a = self.remote.update (m, chunk[m['id']], self.local.state.last_historyId, self.force)
+          if a:
+            actions.append (a)
 
-      # resolve changes
-      bar = tqdm (leave = True, total = len(gids), desc = 'resolving changes')
-      actions = []
-      for rm, nm in zip(remote_messages, messages):
-        actions.append (self.remote.update (rm, nm, self.local.state.last_historyId, self.force))
-        bar.update (1)
+        def _got_msgs (ms):
+          for m in ms:
+            self.local.shadow.set (m['id'], int(m['historyId']), m.get ('labelIds', []))
+            _update (m)
 
-      bar.close ()
+        fetch = []
+        for (gid, nm) in chunk.items ():
+          shadow = None
+          if remote_changed is not None and gid not in remote_changed:
+            shadow = self.local.shadow.get (gid)
 
-      # remove no-ops
-      actions = [ a for a in actions if a ]
+          if shadow is None:
+            fetch.append (gid)
+          else:
+            self.stats.add ('shadow_hits')
+            _update ({ 'id' : gid, 'labelIds' : shadow[1], 'historyId' : str(shadow[0]) })
 
-      # limit
-      if self.limit is not None and len(actions) >= self.limit:
-        actions = actions[:self.limit]
+        if len(fetch) > 0:
+          with self.stats.phase ('push.metadata'):
+            self.remote.get_messages (fetch, _got_msgs, 'minimal')
 
-      # push changes
-      if len(actions) > 0:
-        bar = tqdm (leave = True, total = len(actions), desc = 'pushing, 0 changed')
-        changed = 0
+        chunk.clear ()
 
-        def cb (resp):
-          nonlocal changed
-          bar.update (1)
-          changed += 1
-          bar.set_description ('pushing, %d changed' % changed)
+        # limit
+        if self.limit is not None and pushed + len(actions) >= self.limit:
+          del actions[self.limit - pushed:]
 
-        self.remote.push_changes (actions, cb)
+        if len(actions) > 0:
+          push_bar.total += len(actions)
+          push_bar.refresh ()
 
-        bar.close ()
-      else:
+          def cb (resp):
+            nonlocal changed
+            push_bar.update (1)
+            changed += 1
+            push_bar.set_description ('pushing, %d changed' % changed)
+            self.stats.add ('messages_pushed')
+
+            if 'labelIds' in resp:
+              self.local.shadow.set_labels (resp['id'], resp['labelIds'])
+
+          with self.stats.phase ('push.modify'):
+            self.remote.push_changes (actions, cb)
+
+          pushed += len(actions)
+
+        self.local.shadow.commit ()
+
+      # get gids and filter out messages outside this repository
+      changes = self.local.messages_to_gids (messages, snapshot = self.shared_db is not None)
+
+      if self.shared_db is not None:
+        # in sync-all the other accounts commit to notmuch while we are
+        # pushing, after a couple of commits the revision the query is
+        # reading is discarded. all the changes are read before pushing any.
+        changes = list (changes)
+
+      try:
+        for (nm, gid) in changes:
+          chunk[gid] = nm
+          n += 1
+
+          if len(chunk) >= self.PUSH_CHUNK:
+            _push_chunk ()
+
+          if self.limit is not None and (n >= self.limit or pushed >= self.limit):
+            break
+
+        if len(chunk) > 0 and (self.limit is None or pushed < self.limit):
+          _push_chunk ()
+
+      finally:
+        meta_bar.close ()
+        push_bar.close ()
+
+      if pushed == 0:
         print ('push: nothing to push')
 
     if not self.remote.all_updated:
@@ -360,7 +724,11 @@ class Gmailieer:
     if not self.dry_run and self.remote.all_updated:
       self.local.state.set_lastmod (rev)
 
-    print ("remote historyId: %d" % self.remote.get_current_history_id (self.local.state.last_historyId))
+    hid = self.remote.current_history_id
+    if hid is None:
+      hid = self.remote.get_current_history_id (self.local.state.last_historyId)
+
+    print ("remote historyId: %d" % hid)
 
   def pull (self, args, setup = False):
     if not setup:
@@ -369,6 +737,8 @@ class Gmailieer:
       self.list_labels      = args.list_labels
       self.force            = args.force
       self.limit            = args.limit
+      self.adopt            = args.adopt
+      self.remote.jobs      = args.jobs
 
       self.remote.get_labels () # to make sure label map is initialized
 
@@ -381,41 +751,52 @@ class Gmailieer:
         print ("{0: <30} {1}".format (l, k))
       return
 
-    if self.force:
-      print ("pull: full synchronization (forced)")
-      self.full_pull ()
+    # keep the database open for writing during the whole pull
+    with self.writer:
+      if self.force:
+        print ("pull: full synchronization (forced)")
+        self.full_pull ()
 
-    elif self.local.state.last_historyId == 0:
-      print ("pull: full synchronization (no previous synchronization state)")
-      self.full_pull ()
+      elif self.local.state.full_sync is not None and not self.remove:
+        print ("pull: full synchronization (resuming interrupted synchronization)")
+        self.full_pull (resume = True)
 
-    elif self.remove:
-      print ("pull: full synchronization (removing deleted messages)")
-      self.full_pull ()
+      elif self.local.state.last_historyId == 0:
+        print ("pull: full synchronization (no previous synchronization state)")
+        self.full_pull ()
 
-    else:
-      print ("pull: partial synchronization.. (hid: %d)" % self.local.state.last_historyId)
-      self.partial_pull ()
+      elif self.remove:
+        print ("pull: full synchronization (removing deleted messages)")
+        self.full_pull ()
+
+      else:
+        print ("pull: partial synchronization.. (hid: %d)" % self.local.state.last_historyId)
+        self.partial_pull ()
 
   def partial_pull (self):
+    from googleapiclient.errors import HttpError
+    from .remote import Remote
+
     # get history
     bar         = None
     history     = []
-    last_id     = self.remote.get_current_history_id (self.local.state.last_historyId)
+
+    self.remote.current_history_id = None
 
     try:
-      for hist in self.remote.get_history_since (self.local.state.last_historyId):
-        history.extend (hist)
+      with self.stats.phase ('pull.history'):
+        for hist in self.remote.get_history_since (self.local.state.last_historyId):
+          history.extend (hist)
 
-        if bar is None:
-          bar = tqdm (leave = True, desc = 'fetching changes')
+          if bar is None:
+            bar = self.tqdm (leave = True, desc = 'fetching changes')
 
-        bar.update (len(hist))
+          bar.update (len(hist))
 
-        if self.limit is not None and len(history) >= self.limit:
-          break
+          if self.limit is not None and len(history) >= self.limit:
+            break
 
-    except googleapiclient.errors.HttpError as excep:
+    except HttpError as excep:
       if excep.resp.status == 404:
         print ("pull: historyId is too old, full sync required.")
         self.full_pull ()
@@ -430,97 +811,30 @@ class Gmailieer:
     finally:
       if bar is not None: bar.close ()
 
+    # the current historyId is returned with the first page of the history
+    last_id = self.remote.current_history_id
+    if last_id is None:
+      last_id = self.remote.get_current_history_id (self.local.state.last_historyId)
+
     # figure out which changes need to be applied
-    added_messages   = [] # added messages, if they are later deleted they will be
-                          # removed from this list
-
-    deleted_messages = [] # deleted messages, if they are later added they will be
-                          # removed from this list
-
-    labels_changed   = [] # list of messages which have had their label changed
-                          # the entry will be the last and most recent one in case
-                          # of multiple changes. if the message is either deleted
-                          # or added after the label change it will be removed from
-                          # this list.
-
-    def remove_from_all (m):
-      nonlocal added_messages, deleted_messages, labels_changed
-      remove_from_list (deleted_messages, m)
-      remove_from_list (labels_changed, m)
-      remove_from_list (added_messages, m)
-
-    def remove_from_list (lst, m):
-      e = next ((e for e in lst if e['id'] ==  m['id']), None)
-      if e is not None:
-        lst.remove (e)
-        return True
-      return False
+    changes = ChangeSet (self.local.has, self.remote.not_sync)
 
     if len(history) > 0:
-      bar = tqdm (total = len(history), leave = True, desc = 'resolving changes')
+      bar = self.tqdm (total = len(history), leave = True, desc = 'resolving changes')
     else:
       bar = None
 
-    for h in history:
-      if 'messagesAdded' in h:
-        for m in h['messagesAdded']:
-          mm = m['message']
-          if not (set(mm.get('labelIds', [])) & self.remote.not_sync):
-            remove_from_all (mm)
-            added_messages.append (mm)
-
-      if 'messagesDeleted' in h:
-        for m in h['messagesDeleted']:
-          mm = m['message']
-          # might silently fail to delete this
-          remove_from_all (mm)
-          if self.local.has (mm['id']):
-            deleted_messages.append (mm)
-
-      # messages that are subsequently deleted by a later action will be removed
-      # from either labels_changed or added_messages.
-      if 'labelsAdded' in h:
-        for m in h['labelsAdded']:
-          mm = m['message']
-          if not (set(mm.get('labelIds', [])) & self.remote.not_sync):
-            new = remove_from_list (added_messages, mm) or not self.local.has (mm['id'])
-            remove_from_list (labels_changed, mm)
-            if new:
-              added_messages.append (mm) # needs to fetched
-            else:
-              labels_changed.append (mm)
-          else:
-            # in case a not_sync tag has been added to a scheduled message
-            remove_from_list (added_messages, mm)
-            remove_from_list (labels_changed, mm)
-
-            if self.local.has (mm['id']):
-              remove_from_list (deleted_messages, mm)
-              deleted_messages.append (mm)
-
-      if 'labelsRemoved' in h:
-        for m in h['labelsRemoved']:
-          mm = m['message']
-          if not (set(mm.get('labelIds', [])) & self.remote.not_sync):
-            new = remove_from_list (added_messages, mm) or not self.local.has (mm['id'])
-            remove_from_list (labels_changed, mm)
-            if new:
-              added_messages.append (mm) # needs to fetched
-            else:
-              labels_changed.append (mm)
-          else:
-            # in case a not_sync tag has been added
-            remove_from_list (added_messages, mm)
-            remove_from_list (labels_changed, mm)
-
-            if self.local.has (mm['id']):
-              remove_from_list (deleted_messages, mm)
-              deleted_messages.append (mm)
-
-      bar.update (1)
+    with self.stats.phase ('pull.resolve'):
+      for h in history:
+        changes.apply (h)
+        bar.update (1)
 
     if bar: bar.close ()
 
+    added_messages   = changes.added_messages
+    deleted_messages = changes.deleted_messages
+    labels_changed   = changes.changed_messages
+
     changed = False
     # fetching new messages
     if len (added_messages) > 0:
@@ -528,135 +842,383 @@ class Gmailieer:
       updated     = self.get_content (message_gids)
 
       # updated labels for the messages that already existed
-      needs_update_gid = list(set(message_gids) - set(updated))
+      needs_update_gid = set(message_gids) - set(updated)
       needs_update = [m for m in added_messages if m['id'] in needs_update_gid]
       labels_changed.extend (needs_update)
 
       changed = True
 
     if len (deleted_messages) > 0:
-      with notmuch.Database (mode = notmuch.Database.MODE.READ_WRITE) as db:
-        for m in tqdm (deleted_messages, leave = True, desc = 'removing messages'):
-          self.local.remove (m['id'], db)
+      with self.stats.phase ('pull.remove'):
+        for m in self.tqdm (deleted_messages, leave = True, desc = 'removing messages'):
+          with self.writer.batch () as db:
+            self.local.remove (m['id'], db)
 
       changed = True
 
     if len (labels_changed) > 0:
       lchanged = 0
-      with notmuch.Database (mode = notmuch.Database.MODE.READ_WRITE) as db:
-        bar = tqdm (total = len(labels_changed), leave = True, desc = 'updating tags (0Δ)')
+      bar = self.tqdm (total = len(labels_changed), leave = True, desc = 'updating tags (0Δ)')
+      with self.stats.phase ('pull.tags'):
         for m in labels_changed:
-          r = self.local.update_tags (m, None, db)
+          with self.writer.batch () as db:
+            r = self.local.update_tags (m, None, db)
           if r:
             lchanged += 1
             bar.set_description ('updating tags (%dΔ)' % lchanged)
 
           bar.update (1)
-        bar.close ()
-
+      bar.close ()
 
       changed = True
 
     if not changed:
       print ("pull: everything is up-to-date.")
 
+    # make sure all changes are written before moving the historyId on
+    self.writer.flush ()
+
     if not self.dry_run:
       self.local.state.set_last_history_id (last_id)
 
     if (last_id > 0):
       print ('current historyId: %d' % last_id)
 
-  def full_pull (self):
+  def full_pull (self, resume = False):
+    """
+    Synchronize all messages.
+
+    The progress is checkpointed in the state after every chunk of messages
+    from the listing has been fetched, if the synchronization is interrupted
+    it can be continued with `resume`. The messages that were already stored
+    and are still to be reconciled are kept in the index database with the
+    checkpoint. It is not possible to resume when removing messages since all
+    remote messages must then have been seen.
+    """
+    from googleapiclient.errors import HttpError
+
     total = 1
 
-    bar = tqdm (leave = True, total = total, desc = 'fetching messages')
+    if self.remove and self.limit and not self.dry_run:
+      raise argparse.ArgumentError ('--limit with --remove will cause lots of messages to be deleted')
+
+    checkpoint = self.local.state.full_sync
 
-    # NOTE:
-    # this list might grow gigantic for large quantities of e-mail, not really sure
-    # about how much memory this will take. this is just a list of some
-    # simple metadata like message ids.
-    message_gids = []
-    last_id      = self.remote.get_current_history_id (self.local.state.last_historyId)
+    if resume and checkpoint is not None and not self.remove:
+      start   = checkpoint['pageToken']
+      last_id = checkpoint['historyId']
+      done    = checkpoint['done']
+      print ("pull: resuming after %d messages (hid: %d)" % (done, last_id))
 
-    for mset in self.remote.all_messages ():
-      (total, gids) = mset
+    else:
+      start   = None
+      last_id = self.remote.get_current_history_id (self.local.state.last_historyId)
+      done    = 0
+
+    bar = self.tqdm (leave = True, total = total, initial = done, desc = 'fetching messages')
+    content_bar = self.tqdm (leave = True, total = 0, desc = 'receiving content')
+    meta_bar    = self.tqdm (leave = True, total = 0, desc = 'receiving metadata')
+
+    # the message ids are dispatched for fetching as the pages of the
+    # listing arrive, so only the ids of messages that have been seen are
+    # kept (compactly, sorted when the listing is done), and only if they are
+    # needed for removing deleted messages.
+    seen         = array ('Q') if self.remove else None
+    seen_other   = set ()
+    need_content = []
+    need_meta    = []
+    n            = 0
+
+    # the messages that are already stored are reconciled after the listing,
+    # those of the pages before a checkpoint are remembered with it. (a
+    # checkpoint of an older version does not have them, the messages of the
+    # pages before it would be missed.)
+    if start is None:
+      present = array ('Q')
+      if not self.dry_run:
+        self.local.shadow.clear_unreconciled ()
+
+    elif checkpoint.get ('reconcile', False):
+      present = self.local.shadow.unreconciled ()
 
-      bar.total = total
-      bar.update (len(gids))
+    else:
+      present = None
 
-      for m in gids:
-        message_gids.append (m['id'])
+    saved = len(present) if present is not None else 0
 
-      if self.limit is not None and len(message_gids) >= self.limit:
-        break
+    def _dispatch ():
+      nonlocal done
 
-    bar.close ()
+      if len(need_content) > 0:
+        content_bar.total += len(need_content)
+        self.get_content (need_content, content_bar)
+        done += len(need_content)
+        need_content.clear ()
 
-    if self.remove:
-      if self.limit and not self.dry_run:
-        raise argparse.ArgumentError ('--limit with --remove will cause lots of messages to be deleted')
+      if len(need_meta) > 0:
+        meta_bar.total += len(need_meta)
+        self.get_meta (need_meta, meta_bar)
+        done += len(need_meta)
+        need_meta.clear ()
 
+    try:
+      for mset in self.remote.all_messages (start = start):
+        (total, gids, next_page) = mset
+
+        bar.total = total
+        bar.update (len(gids))
+
+        for m in gids:
+          gid = m['id']
+          c   = self.__compact_gid__ (gid)
+
+          if seen is not None:
+            if isinstance (c, int):
+              seen.append (c)
+            else:
+              seen_other.add (c)
+
+          if self.local.has (gid):
+            if present is not None and isinstance (c, int):
+              present.append (c)
+            else:
+              need_meta.append (gid)
+          else:
+            need_content.append (gid)
+
+        n += len(gids)
+
+        if len(need_content) + len(need_meta) >= self.FULL_PULL_CHUNK:
+          _dispatch ()
+
+          # everything up to the next page has now been stored
+          self.writer.flush ()
+
+          # and the messages to be reconciled are remembered. if we are
+          # interrupted before the checkpoint some of them are remembered
+          # twice, they are then only fetched again when reconciling.
+          if present is not None and not self.dry_run:
+            self.local.shadow.add_unreconciled (present[saved:])
+            self.local.shadow.commit ()
+            saved = len(present)
+
+          if not self.dry_run and next_page is not None:
+            self.local.state.set_full_sync ({ 'pageToken' : next_page,
+                                              'historyId' : last_id,
+                                              'done'      : done,
+                                              'reconcile' : present is not None })
+
+        if self.limit is not None and n >= self.limit:
+          break
+
+      _dispatch ()
+
+    except HttpError as excep:
+      if start is not None and n == 0 and excep.resp.status == 400:
+        # the page token is no longer valid
+        print ("pull: cannot resume full synchronization, starting over.")
+        return self.full_pull ()
+      else:
+        raise
+
+    finally:
+      bar.close ()
+      content_bar.close ()
+      meta_bar.close ()
+
+    if n == 0:
+      print ("pull: no messages.")
+
+    if present:
+      if len(present) > len(self.remote.labels) + total // self.RECONCILE_MESSAGES_PER_REQUEST:
+        self.reconcile (present, last_id)
+      else:
+        present = set (present)
+        self.get_meta ([ gid for gid in self.local.index.gids () if self.__compact_gid__ (gid) in present ])
+
+    if present is not None and not self.dry_run:
+      # committed with the state below
+      self.local.shadow.clear_unreconciled ()
+
+    if self.remove:
       # removing files that have been deleted remotely
-      all_remote = set (message_gids)
-      all_local  = set (self.local.gids.keys ())
-      remove     = list(all_local - all_remote)
-      bar = tqdm (leave = True, total = len(remove), desc = 'removing deleted')
-      with notmuch.Database (mode = notmuch.Database.MODE.READ_WRITE) as db:
+      seen = array ('Q', sorted (seen))
+      N    = len(seen)
+
+      def _seen (gid):
+        c = self.__compact_gid__ (gid)
+        if not isinstance (c, int):
+          return c in seen_other
+
+        i = bisect_left (seen, c)
+        return i < N and seen[i] == c
+
+      remove = [ gid for gid in self.local.index.gids () if not _seen (gid) ]
+      bar = self.tqdm (leave = True, total = len(remove), desc = 'removing deleted')
+      with self.stats.phase ('pull.remove'):
         for m in remove:
-          self.local.remove (m, db)
+          with self.writer.batch () as db:
+            self.local.remove (m, db)
           bar.update (1)
 
       bar.close ()
 
-    if len(message_gids) > 0:
-      # get content for new messages
-      updated = self.get_content (message_gids)
-
-      # get updated labels for the rest
-      needs_update = list(set(message_gids) - set(updated))
-      self.get_meta (needs_update)
-    else:
-      print ("pull: no messages.")
-
     # set notmuch lastmod time, since we have now synced everything from remote
     # to local
-    with notmuch.Database () as db:
-      (rev, uuid) = db.get_revision ()
+    with self.writer:
+      self.writer.flush ()
+      (rev, uuid) = self.writer.db.get_revision ()
 
     if not self.dry_run:
-      self.local.state.set_lastmod (rev)
-      self.local.state.set_last_history_id (last_id)
+      # all at once, so that they are never out of step
+      self.local.state.update (lastmod = rev, last_historyId = last_id,
+                               full_sync = None, adopt = False)
 
     print ('current historyId: %d, current revision: %d' % (last_id, rev))
 
-  def get_meta (self, msgids):
+  def reconcile (self, present, history):
+    """
+    Bring the tags of the stored messages `present` (the compact gids of
+    messages that were in the remote listing) up to date, getting the
+    metadata only of the messages whose labels have changed.
+
+    The membership of each label is kept as a bitmap over the sorted gids of
+    `present`. The local bitmaps are built from the tags in notmuch in one
+    scan, and compared to the bitmap of the messages listed with the label
+    on the remote. The labels of the messages that are unchanged are stored
+    in the shadow as of `history`.
+    """
+    import notmuch
+
+    self.writer.flush ()
+
+    present = array ('Q', sorted (present))
+    N       = len(present)
+    nbytes  = (N + 7) // 8
+
+    def _index (gid):
+      c = self.__compact_gid__ (gid)
+      if not isinstance (c, int):
+        return -1
+
+      i = bisect_left (present, c)
+      return i if i < N and present[i] == c else -1
+
+    # the ignored labels are not listed, they are not synchronized
+    labels = [ lid for (lid, l) in self.remote.labels.items ()
+                 if l not in self.remote.ignore_labels and lid not in self.remote.not_sync ]
+
+    local = dict ((lid, bytearray (nbytes)) for lid in labels)
+    seen  = bytearray (nbytes)
+    dirty = bytearray (nbytes) # has tags that are not labels on the remote
+
+    print ("pull: reconciling the labels of %d messages.." % N)
+
+    with self.stats.phase ('pull.reconcile'):
+      with notmuch.Database () as db:
+        query = notmuch.Query (db, 'path:%s/**' % self.local.nm_relative)
+
+        for (nm, gid) in self.local.messages_to_gids (query.search_messages ()):
+          i = _index (gid)
+          if i < 0:
+            continue
+
+          (b, bit) = (i >> 3, 1 << (i & 7))
+          seen[b] |= bit
+
+          lids = []
+          for t in nm.get_tags ():
+            if t in self.local.ignore_labels:
+              continue
+
+            lid = self.label_translator.local_to_label_id (t)
+            if lid in local:
+              local[lid][b] |= bit
+              lids.append (lid)
+            else:
+              dirty[b] |= bit
+
+          # if the labels differ the shadow is updated with the metadata below
+          self.local.shadow.set (gid, history, lids)
+
+      # messages that are not in notmuch (yet) have changed
+      diff = int.from_bytes (dirty, 'little') | (((1 << N) - 1) & ~int.from_bytes (seen, 'little'))
+      del dirty, seen
+
+      bar = self.tqdm (leave = True, total = len(labels), desc = 'listing labels')
+      for lid in labels:
+        r = bytearray (nbytes)
+        for gids in self.remote.label_messages (lid):
+          for gid in gids:
+            i = _index (gid)
+            if i >= 0:
+              r[i >> 3] |= 1 << (i & 7)
+
+        diff |= int.from_bytes (r, 'little') ^ int.from_bytes (local.pop (lid), 'little')
+        bar.update (1)
+
+      bar.close ()
+
+    diff = diff.to_bytes (nbytes, 'little')
+
+    def _changed (gid):
+      i = _index (gid)
+      return i >= 0 and (diff[i >> 3] >> (i & 7)) & 1
+
+    changed = [ gid for gid in self.local.index.gids () if _changed (gid) ]
+    self.stats.add ('messages_reconciled', N)
+
+    print ("pull: %d of %d messages have changed labels" % (len(changed), N))
+    self.get_meta (changed)
+
+  @staticmethod
+  def __compact_gid__ (gid):
+    """
+    GMail ids are hexadecimal, as integers they take up a lot less memory
+    than as strings. Anything that does not fit in 64 bits (for an
+    array ('Q')) is returned as the string.
+    """
+    try:
+      k = int (gid, 16)
+    except ValueError:
+      return gid
+
+    return k if 0 <= k < 1 << 64 else gid
+
+  def get_meta (self, msgids, bar = None):
     """
     Only gets the minimal message objects in order to check if labels are up-to-date.
+
+    If `bar` is given progress is reported to it, otherwise a new progress bar
+    is shown.
     """
 
     if len (msgids) > 0:
 
-      bar = tqdm (leave = True, total = len(msgids), desc = 'receiving metadata')
+      _bar = bar if bar is not None else self.tqdm (leave = True, total = len(msgids), desc = 'receiving metadata')
 
-      # opening db for whole metadata sync
       def _got_msgs (ms):
-        with notmuch.Database (mode = notmuch.Database.MODE.READ_WRITE) as db:
+        with self.writer.batch (len(ms)) as db:
           for m in ms:
-            bar.update (1)
+            _bar.update (1)
             self.local.update_tags (m, None, db)
 
+      with self.stats.phase ('pull.metadata'):
         self.remote.get_messages (msgids, _got_msgs, 'minimal')
 
-      bar.close ()
+      if bar is None: _bar.close ()
 
-    else:
+    elif bar is None:
       print ("receiving metadata: everything up-to-date.")
 
 
-  def get_content (self, msgids):
+  def get_content (self, msgids, bar = None):
     """
     Get the full email source of the messages that we do not already have
 
+    If `bar` is given progress is reported to it, otherwise a new progress bar
+    is shown.
+
     Returns:
       list of messages which were updated, these have also been updated in Notmuch and
       does not need to be partially upated.
@@ -667,24 +1229,74 @@ class Gmailieer:
 
     if len (need_content) > 0:
 
-      bar = tqdm (leave = True, total = len(need_content), desc = 'receiving content')
+      _bar = bar if bar is not None else self.tqdm (leave = True, total = len(need_content), desc = 'receiving content')
+
+      download = need_content
+      if self.adopt or self.local.state.adopt:
+        download = self.adopt_messages (need_content, _bar)
 
       def _got_msgs (ms):
-        # opening db per message batch since it takes some time to download each one
-        with notmuch.Database (mode = notmuch.Database.MODE.READ_WRITE) as db:
+        with self.writer.batch (len(ms)) as db:
           for m in ms:
-            bar.update (1)
+            _bar.update (1)
             self.local.store (m, db)
 
-      self.remote.get_messages (need_content, _got_msgs, 'raw')
+      with self.stats.phase ('pull.content'):
+        self.remote.get_messages (download, _got_msgs, 'raw')
 
-      bar.close ()
+      if bar is None: _bar.close ()
 
-    else:
+    elif bar is None:
       print ("receiving content: everything up-to-date.")
 
     return need_content
 
+  def adopt_messages (self, msgids, bar):
+    """
+    Store the messages that are already in notmuch, e.g. from the maildir of
+    another synchronization tool, with the existing files rather than
+    downloading them. Only the metadata of the messages is fetched, and they
+    are matched by their Message-ID.
+
+    Returns the messages that were not found, which must be downloaded.
+    """
+    remaining = []
+
+    def _message_id (m):
+      for h in m.get ('payload', {}).get ('headers', []):
+        if h['name'].lower () == 'message-id':
+          return h['value'].strip ().lstrip ('<').rstrip ('>')
+
+      return None
+
+    def _got_msgs (ms):
+      with self.writer.batch (len(ms)) as db:
+        for m in ms:
+          mid  = _message_id (m)
+          nmsg = db.find_message (mid) if mid else None
+          src  = None
+
+          if nmsg is not None:
+            for f in nmsg.get_filenames ():
+              if not self.local.contains (f) and os.path.exists (f):
+                src = f
+                break
+
+          if src is None:
+            remaining.append (m['id'])
+
+            # the size is known now, for packing the batches of the download
+            if 'sizeEstimate' in m:
+              self.remote.sizes[m['id']] = m['sizeEstimate']
+          else:
+            bar.update (1)
+            self.local.adopt (m, src, db)
+
+    with self.stats.phase ('pull.adopt'):
+      self.remote.get_messages (msgids, _got_msgs, 'metadata', [ 'Message-ID' ])
+
+    return remaining
+
   def set (self, args):
     args.credentials = '' # for setup()
     self.setup (args, False, True)
@@ -698,6 +1310,12 @@ class Gmailieer:
     if args.no_drop_non_existing_labels:
       self.local.state.set_drop_non_existing_label (not args.no_drop_non_existing_labels)
 
+    if args.write_batch is not None:
+      self.local.state.set_write_batch (args.write_batch)
+
+    if args.durability is not None:
+      self.local.state.set_durability (args.durability)
+
     new_label_translation_value = None
     # the following two settings are mutual exclusive. if none of them
     # is True, leave the state as it is.
@@ -716,6 +1334,8 @@ class Gmailieer:
     print ("historyId .........: %d" % self.local.state.last_historyId)
     print ("lastmod ...........: %d" % self.local.state.lastmod)
     print ("drop non labels ...:", self.local.state.drop_non_existing_label)
+    print ("write batch .......: %d" % self.local.state.write_batch)
+    print ("durability ........: %s" % self.local.state.durability)
     print ("Use user's label translation: {}".format(
       self.local.state.user_label_translation))
 
@@ -5,6 +5,9 @@ import json
 class LabelTranslator:
 
     gmail_label_sep = '/'
+
+    # the translations of this many sets of label ids are remembered
+    max_memo = 100000
     
     default_remote_to_local_map = {
         'INBOX'     : 'inbox',
@@ -51,7 +54,14 @@ class LabelTranslator:
     
     def _update_local_to_remote_map(self):
         self._local_to_remote_map = {v: k for k, v in self._remote_to_local_map.items()}
-        
+        self._reset()
+
+    def _reset(self):
+        # the translation changed, the compiled tables are stale
+        self._id_to_local = {}
+        self._local_to_id = {}
+        self._id_sets = {}
+        self._to_remote = {}
     
     def __init__ (self):
 
@@ -82,6 +92,7 @@ class LabelTranslator:
     @label_separator.setter
     def label_separator(self, sep):
         self._label_separator = sep
+        self._reset()
 
     @property
     def has_user_map(self):
@@ -95,12 +106,16 @@ class LabelTranslator:
         """
         Translate local label string to the remote value.
         """
-        label = self._local_to_remote_map.get(label, label)
-        if self.label_separator:
-            label = label.replace(self.label_separator,
-                                  LabelTranslator.gmail_label_sep)
+        remote = self._to_remote.get(label)
+        if remote is None:
+            remote = self._local_to_remote_map.get(label, label)
+            if self.label_separator:
+                remote = remote.replace(self.label_separator,
+                                        LabelTranslator.gmail_label_sep)
 
-        return label
+            self._to_remote[label] = remote
+
+        return remote
         
 
     def remote_label_to_local(self, label):
@@ -124,6 +139,60 @@ class LabelTranslator:
 
         return [self.remote_label_to_local(label) for label in labels]
 
+    def compile(self, labels, ignore=()):
+        """
+        Compile the translation of the label ids of the account to local
+        labels. `labels` maps the label ids to the remote label names (as
+        fetched by Remote.get_labels ()), labels named in `ignore` are left
+        out of the translations.
+
+        Must be called again when the labels of the account change.
+        """
+        self._id_to_local = {}
+        self._local_to_id = {}
+        self._id_sets = {}
+
+        for lid, name in labels.items():
+            if name in ignore:
+                self._id_to_local[lid] = None
+            else:
+                local = self.remote_label_to_local(name)
+                self._id_to_local[lid] = local
+                self._local_to_id[local] = lid
+
+    def local_to_label_id(self, label):
+        """
+        Get the id of the remote label of a local label, None if there is no
+        such label (see compile()).
+        """
+        return self._local_to_id.get(label)
+
+    def label_ids_to_local(self, lids):
+        """
+        Translate the label ids of a message to a frozenset of local labels,
+        using the tables made by compile(). Messages mostly share the same few
+        combinations of labels, so the translation of each set of label ids is
+        remembered.
+
+        Returns None if any of the label ids are not known.
+        """
+        key = tuple(lids)
+        local = self._id_sets.get(key)
+
+        if local is None:
+            try:
+                local = frozenset(l for l in map(self._id_to_local.__getitem__, key)
+                                  if l is not None)
+            except KeyError:
+                return None
+
+            if len(self._id_sets) >= LabelTranslator.max_memo:
+                self._id_sets.clear()
+
+            self._id_sets[key] = local
+
+        return local
+
 
 
 def print_label_translation(label_trans):
@@ -2,14 +2,35 @@ import os, shutil
 import json
 import base64
 import configparser
-from pathlib import Path
 import tempfile
+import sqlite3
+import zlib
+import time
+import threading
+from array import array
+from contextlib import contextmanager
 
-import notmuch
+# notmuch is imported when used, see gmailieer.py
 
 class Local:
   wd      = None
   loaded  = False
+  _index  = None
+  _shadow = None
+
+  # when the message files written to the maildir are flushed to disk:
+  #
+  #   none  - left to the operating system
+  #   batch - all the files written since, and the directory, are flushed
+  #           when the changes to notmuch are committed. this happens before
+  #           the historyId of the repository is advanced, so a crash never
+  #           leaves the state pointing past messages that were lost.
+  #   file  - every file, and the directory, is flushed as it is written
+  DURABILITY = [ 'none', 'batch', 'file' ]
+
+  # characters of the base64 encoded content of a message that are decoded at
+  # the time when it is stored (a multiple of 4).
+  DECODE_CHUNK = 1024 * 1024
 
   # ar: need work. 'Trash' will be rejected by Gmail in any
   # letter-case. Need to check the labels after they are tranlated to
@@ -32,6 +53,24 @@ class Local:
     pass
 
   class State:
+    """
+    The state of the repository, kept in `.gmailieer.json`.
+
+    Changes are committed by `update ()`, which appends a record with the
+    changed fields (and a checksum) to a journal next to the state file.
+    The fields of one update are committed together: either all or none of
+    them are found when the state is loaded. The journal is compacted into
+    the state file (keeping the previous one as `.bak`) by `write ()`, and
+    when it has grown to COMPACT_RECORDS records.
+
+    When the state is loaded the records of the journal are applied to the
+    state file, up to the first one that is incomplete or corrupt (e.g. when
+    we were interrupted while writing it). The journal is truncated there.
+    """
+
+    # records in the journal before it is compacted into the state file
+    COMPACT_RECORDS = 1000
+
     # last historyid of last synchronized message, anything that has happened
     # remotely after this needs to be synchronized. gmail may return a 404 error
     # if the history records have been deleted, in which case we have to do a full
@@ -41,62 +80,195 @@ class Local:
     # this is the last modification id of the notmuch db when the previous push was completed.
     lastmod = 0
 
+    # progress of an unfinished full synchronization: the page token of the
+    # next page of the message listing, the historyId when it was started and
+    # the number of messages done.
+    full_sync = None
+
     account = None
     timeout = 5
     drop_non_existing_label = False
 
+    # number of messages written to notmuch in each atomic section
+    write_batch = 500
+
+    # when the message files are flushed to disk (see Local.DURABILITY), also
+    # decides whether the state is.
+    durability = 'batch'
+
+    # adopt messages that are already in notmuch rather than downloading them,
+    # until the first full synchronization has completed.
+    adopt = False
+
     def __init__ (self, state_f):
-      self.state_f = state_f
+      self.state_f   = state_f
+      self.journal_f = os.path.join (os.path.dirname (state_f), '.gmailieer.journal.json')
+      self.records   = 0
 
-      if os.path.exists (self.state_f):
-        with open (self.state_f, 'r') as fd:
-          self.json = json.load (fd)
-      else:
-        self.json = {}
+      self.json = self.__load__ ()
+      self.json.update (self.__replay__ ())
 
       self.last_historyId = self.json.get ('last_historyId', 0)
       self.lastmod = self.json.get ('lastmod', 0)
+      self.full_sync = self.json.get ('full_sync', None)
       self.account = self.json.get ('account', 'me')
       self.timeout = self.json.get ('timeout', 0)
       self.drop_non_existing_label = self.json.get ('drop_non_existing_label', False)
+      self.write_batch = self.json.get ('write_batch', Local.State.write_batch)
+      self.durability = self.json.get ('durability', Local.State.durability)
+      self.adopt = self.json.get ('adopt', False)
       self._user_label_translation = self.json.get('user_label_translation', False)
 
+    def __load__ (self):
+      """
+      Read the state file, falling back to the previous one if it is corrupt
+      """
+      if not os.path.exists (self.state_f):
+        return {}
+
+      try:
+        with open (self.state_f, 'r') as fd:
+          return json.load (fd)
+
+      except ValueError:
+        bak = self.state_f + '.bak'
+        if not os.path.exists (bak):
+          raise Local.RepositoryException ("state file '%s' is corrupt, and there is no backup" % self.state_f)
+
+        print ("local: warning: state file is corrupt, using the backup: %s" % bak)
+        with open (bak, 'r') as fd:
+          return json.load (fd)
+
+    @staticmethod
+    def __record__ (line):
+      """
+      The fields of a journal record, or None if it is incomplete or corrupt
+      """
+      if not line.endswith (b'\n'):
+        return None
+
+      (crc, _, data) = line[:-1].partition (b' ')
+      try:
+        if int (crc, 16) != zlib.crc32 (data):
+          return None
+        return json.loads (data.decode ('utf-8'))
+
+      except ValueError:
+        return None
+
+    def __replay__ (self):
+      """
+      Collect the changes in the journal, truncating it after the last
+      complete record.
+      """
+      fields = {}
+
+      if not os.path.exists (self.journal_f):
+        return fields
+
+      with open (self.journal_f, 'rb+') as fd:
+        good = 0
+        for line in fd:
+          r = self.__record__ (line)
+          if r is None:
+            print ("local: warning: discarding incomplete changes to the state at the end of the journal.")
+            fd.truncate (good)
+            break
+
+          fields.update (r)
+          good += len(line)
+          self.records += 1
+
+      return fields
+
+    def __fsync__ (self):
+      return self.durability != 'none'
+
+    def update (self, **fields):
+      """
+      Commit the changes to the `fields` of the state together
+      """
+      for (k, v) in fields.items ():
+        setattr (self, k, v)
+
+      data = json.dumps (fields).encode ('utf-8')
+
+      with open (self.journal_f, 'ab') as fd:
+        fd.write (b'%08x %s\n' % (zlib.crc32 (data), data))
+        fd.flush ()
+
+        if self.__fsync__ ():
+          os.fsync (fd.fileno ())
+
+      self.records += 1
+      if self.records >= self.COMPACT_RECORDS:
+        self.write ()
+
     def write (self):
+      """
+      Write the whole state to the state file, and empty the journal
+      """
       self.json = {}
 
       self.json['last_historyId'] = self.last_historyId
       self.json['lastmod'] = self.lastmod
+      self.json['full_sync'] = self.full_sync
       self.json['account'] = self.account
       self.json['timeout'] = self.timeout
       self.json['drop_non_existing_label'] = self.drop_non_existing_label
+      self.json['write_batch'] = self.write_batch
+      self.json['durability'] = self.durability
+      self.json['adopt'] = self.adopt
       self.json['user_label_translation'] = self._user_label_translation
 
+      d = os.path.dirname (self.state_f)
+
       if os.path.exists (self.state_f):
         shutil.copyfile (self.state_f, self.state_f + '.bak')
 
-      with tempfile.NamedTemporaryFile (mode = 'w+', dir = os.path.dirname (self.state_f), delete = False) as fd:
+      with tempfile.NamedTemporaryFile (mode = 'w+', dir = d, delete = False) as fd:
         json.dump (self.json, fd)
+        fd.flush ()
+
+        if self.__fsync__ ():
+          os.fsync (fd.fileno ())
+
         os.rename (fd.name, self.state_f)
 
+      if self.__fsync__ ():
+        Local.__fsync_dir__ (d or '.')
+
+      # the records of the journal are now in the state file
+      if os.path.exists (self.journal_f):
+        os.truncate (self.journal_f, 0)
+      self.records = 0
+
     def set_last_history_id (self, hid):
-      self.last_historyId = hid
-      self.write ()
+      self.update (last_historyId = hid)
 
     def set_lastmod (self, m):
-      self.lastmod = m
-      self.write ()
+      self.update (lastmod = m)
+
+    def set_full_sync (self, checkpoint):
+      self.update (full_sync = checkpoint)
 
     def set_account (self, a):
-      self.account = a
-      self.write ()
+      self.update (account = a)
 
     def set_timeout (self, t):
-      self.timeout = t
-      self.write ()
+      self.update (timeout = t)
 
     def set_drop_non_existing_label (self, r):
-      self.drop_non_existing_label = r
-      self.write ()
+      self.update (drop_non_existing_label = r)
+
+    def set_write_batch (self, n):
+      self.update (write_batch = n)
+
+    def set_durability (self, d):
+      self.update (durability = d)
+
+    def set_adopt (self, a):
+      self.update (adopt = a)
 
     @property
     def user_label_translation(self):
@@ -107,25 +279,426 @@ class Local:
       self._user_label_translation = val
     
     def set_user_label_translation(self, val=True):
-      self._user_label_translation = val
-      self.write()
+      self.update (user_label_translation = val)
+
+  class Snapshot:
+    """
+    The file names and tags of a notmuch message, read at once, so that they
+    can be used after the query it came from is gone.
+    """
+    def __init__ (self, m):
+      self.filenames = list (m.get_filenames ())
+      self.tags      = list (m.get_tags ())
+
+    def get_filenames (self):
+      return self.filenames
+
+    def get_tags (self):
+      return self.tags
+
+  class Index:
+    """
+    Persistent index of the message files in the maildir, mapping GIDs to
+    file names relative to the maildir.
+
+    The index is validated against the modification times of the `cur` and
+    `new` directories recorded when they were last scanned. If any of them
+    have changed (e.g. by notmuch renaming files when synchronizing maildir
+    flags) the directories are rescanned, and the entries of the files that
+    changed are updated. Changes are only persisted by `commit ()`.
+
+    The modification times are not recorded again when committing: the
+    directories may also have been changed by others while we were running,
+    so they are rescanned on the next run whenever anything was written.
+    """
+
+    VERSION = 1
 
-  def __init__ (self, g):
+    def __init__ (self, index_f, md, dry_run = False):
+      self.md      = md
+      self.dry_run = dry_run
+
+      self.db = sqlite3.connect (index_f)
+      self.db.execute ('PRAGMA journal_mode = WAL')
+      self.db.execute ('PRAGMA synchronous = NORMAL')
+      self.db.execute ('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+      self.db.execute ('CREATE TABLE IF NOT EXISTS files (fname TEXT PRIMARY KEY, gid TEXT NOT NULL)')
+      self.db.execute ('CREATE INDEX IF NOT EXISTS files_gid ON files (gid)')
+      self.db.commit ()
+
+      self.check ()
+
+    def __stamps__ (self):
+      stamps = { 'version' : self.VERSION }
+      for d in ('cur', 'new'):
+        stamps[d] = os.stat (os.path.join (self.md, d)).st_mtime_ns
+
+      return stamps
+
+    def __write_stamps__ (self, stamps):
+      self.db.executemany ('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', stamps.items ())
+
+    def valid (self):
+      """ Check whether the index matches the maildir """
+      stored = dict (self.db.execute ('SELECT key, value FROM meta'))
+      return stored == self.__stamps__ ()
+
+    def check (self):
+      """ Bring the index up to date with the maildir if it does not match """
+      stored = dict (self.db.execute ('SELECT key, value FROM meta'))
+      stamps = self.__stamps__ ()
+
+      if stored == stamps:
+        return
+
+      if stored.get ('version') != self.VERSION:
+        self.db.execute ('DELETE FROM files')
+        self.rescan ()
+      else:
+        self.rescan ([ d for d in ('cur', 'new') if stored.get (d) != stamps[d] ])
+
+    def rescan (self, dirs = ('cur', 'new')):
+      """
+      Update the index from the files in the maildir directories `dirs`.
+
+      The listing of each directory is compared to the files in the index,
+      only the entries of files that have been removed or added (e.g.
+      renamed by notmuch when synchronizing maildir flags) are changed.
+      """
+      # get the stamps before listing, so that any changes made while
+      # scanning will cause another rescan. only the stamps of the
+      # directories that are scanned are updated.
+      stamps = dict (self.db.execute ('SELECT key, value FROM meta'))
+      now    = self.__stamps__ ()
+      stamps['version'] = self.VERSION
+      for d in dirs:
+        stamps[d] = now[d]
+
+      if len(dirs) == 2:
+        stored = set (f for (f,) in self.db.execute ('SELECT fname FROM files'))
+      else:
+        stored = set ()
+        for d in dirs:
+          stored.update (f for (f,) in self.db.execute (
+            'SELECT fname FROM files WHERE fname >= ? AND fname < ?', (d + '/', d + '0')))
+
+      listed = set ()
+      for d in dirs:
+        with os.scandir (os.path.join (self.md, d)) as it:
+          # exclude files that are unlikely to be real message files
+          listed.update (d + '/' + e.name for e in it if e.name[0] != '.')
+
+      self.db.executemany ('DELETE FROM files WHERE fname = ?',
+          ( (f,) for f in stored - listed ))
+      self.db.executemany ('INSERT OR REPLACE INTO files (fname, gid) VALUES (?, ?)',
+          ( (f, f[4:].split (':')[0]) for f in listed - stored ))
+
+      self.__write_stamps__ (stamps)
+      self.db.commit ()
+
+    def commit (self):
+      """ Persist changes to the index """
+      if self.dry_run:
+        return
+
+      self.db.commit ()
+
+    def __contains__ (self, gid):
+      return self.db.execute ('SELECT 1 FROM files WHERE gid = ? LIMIT 1', (gid,)).fetchone () is not None
+
+    def __len__ (self):
+      return self.db.execute ('SELECT COUNT(DISTINCT gid) FROM files').fetchone ()[0]
+
+    def __getitem__ (self, gid):
+      fname = self.get (gid)
+      if fname is None:
+        raise KeyError (gid)
+      return fname
+
+    def get (self, gid, default = None):
+      """
+      Get file name for gid, there might be more files for each gid, if so the
+      last added one is used.
+      """
+      r = self.db.execute ('SELECT fname FROM files WHERE gid = ? ORDER BY rowid DESC LIMIT 1', (gid,)).fetchone ()
+      return r[0] if r is not None else default
+
+    def gids (self):
+      """ Iterate over all gids in the index """
+      for (gid,) in self.db.execute ('SELECT DISTINCT gid FROM files'):
+        yield gid
+
+    def add (self, gid, fname):
+      self.db.execute ('INSERT OR REPLACE INTO files (fname, gid) VALUES (?, ?)', (fname, gid))
+
+    def remove (self, fname):
+      self.db.execute ('DELETE FROM files WHERE fname = ?', (fname,))
+
+    def rename (self, old, new):
+      """ Point the entry of file name `old` to `new`, keeping its gid """
+      self.db.execute ('UPDATE OR REPLACE files SET fname = ? WHERE fname = ?', (new, old))
+
+  class Shadow:
+    """
+    The label ids and historyId each message had remotely when it was last
+    pulled or pushed, kept in the same database as the Index and committed
+    with it.
+
+    This lets push diff local tags against the last known remote labels
+    without fetching the messages that have not changed remotely since.
+
+    GIDs are stored as integers and the label ids are interned, every row
+    stores its labels as a packed array of the interned numbers.
+    """
+
+    def __init__ (self, db, dry_run = False):
+      self.db      = db
+      self.dry_run = dry_run
+
+      self.db.execute ('CREATE TABLE IF NOT EXISTS label_ids (n INTEGER PRIMARY KEY, label TEXT UNIQUE NOT NULL)')
+      self.db.execute ('CREATE TABLE IF NOT EXISTS shadow (gid INTEGER PRIMARY KEY, history INTEGER NOT NULL, labels BLOB NOT NULL)')
+      self.db.execute ('CREATE TABLE IF NOT EXISTS unreconciled (n INTEGER PRIMARY KEY, gids BLOB NOT NULL)')
+      self.db.commit ()
+
+      self.numbers = dict ((l, n) for (n, l) in self.db.execute ('SELECT n, label FROM label_ids'))
+      self.labels  = dict ((n, l) for (l, n) in self.numbers.items ())
+
+    @staticmethod
+    def __key__ (gid):
+      """
+      GIDs are 64 bit hexadecimal numbers, stored as signed integers. Returns
+      None for anything else.
+      """
+      try:
+        k = int (gid, 16)
+      except ValueError:
+        return None
+
+      if k >= 1 << 64:
+        return None
+
+      return k - (1 << 64) if k >= 1 << 63 else k
+
+    def __intern__ (self, label):
+      n = self.numbers.get (label)
+      if n is None:
+        n = len (self.numbers) + 1
+        self.db.execute ('INSERT INTO label_ids (n, label) VALUES (?, ?)', (n, label))
+        self.numbers[label] = n
+        self.labels[n]      = label
+
+      return n
+
+    def __pack__ (self, labels):
+      return array ('H', sorted (self.__intern__ (l) for l in labels)).tobytes ()
+
+    def __unpack__ (self, b):
+      a = array ('H')
+      a.frombytes (b)
+      return [ self.labels[n] for n in a ]
+
+    def get (self, gid):
+      """
+      Returns (historyId, label ids) for gid, or None if not known
+      """
+      k = self.__key__ (gid)
+      if k is None:
+        return None
+
+      r = self.db.execute ('SELECT history, labels FROM shadow WHERE gid = ?', (k,)).fetchone ()
+      if r is None:
+        return None
+
+      return (r[0], self.__unpack__ (r[1]))
+
+    def set (self, gid, history, labels):
+      k = self.__key__ (gid)
+      if k is not None:
+        self.db.execute ('INSERT OR REPLACE INTO shadow (gid, history, labels) VALUES (?, ?, ?)',
+            (k, history, self.__pack__ (labels)))
+
+    def set_labels (self, gid, labels):
+      """ Update the labels of gid, keeping its historyId """
+      k = self.__key__ (gid)
+      if k is not None:
+        self.db.execute ('UPDATE shadow SET labels = ? WHERE gid = ?', (self.__pack__ (labels), k))
+
+    def remove (self, gid):
+      k = self.__key__ (gid)
+      if k is not None:
+        self.db.execute ('DELETE FROM shadow WHERE gid = ?', (k,))
+
+    def add_unreconciled (self, gids):
+      """
+      Remember the messages (an array ('Q') of compact gids) that are to be
+      reconciled at the end of a full pull, so that it may be resumed.
+      """
+      if len(gids) > 0:
+        self.db.execute ('INSERT INTO unreconciled (gids) VALUES (?)', (gids.tobytes (),))
+
+    def unreconciled (self):
+      """ The messages remembered by add_unreconciled () """
+      a = array ('Q')
+      for (b,) in self.db.execute ('SELECT gids FROM unreconciled ORDER BY n'):
+        a.frombytes (b)
+      return a
+
+    def clear_unreconciled (self):
+      self.db.execute ('DELETE FROM unreconciled')
+
+    def commit (self):
+      """
+      Persist changes to the shadow, when the maildir has not been changed.
+      Otherwise use Index.commit ().
+      """
+      if not self.dry_run:
+        self.db.commit ()
+
+  class SharedDatabase:
+    """
+    The notmuch database opened for writing, shared by the Writers of all
+    repositories synchronized by this process. Only one writer may have the
+    database open at the time, so rather than each opening it in turn they
+    take turns holding `lock` while writing to the one open database.
+
+    The database is open while any of the writers are open.
+    """
+
+    def __init__ (self):
+      self.lock    = threading.RLock ()
+      self.db      = None
+      self.users   = 0
+      self.pending = 0
+
+    def open (self):
+      with self.lock:
+        if self.users == 0:
+          import notmuch
+          self.db = notmuch.Database (mode = notmuch.Database.MODE.READ_WRITE)
+          self.db.begin_atomic ()
+          self.pending = 0
+
+        self.users += 1
+
+    def close (self):
+      with self.lock:
+        self.users -= 1
+
+        if self.users == 0:
+          self.db.end_atomic ()
+          self.db.close ()
+          self.db = None
+
+    def commit (self):
+      """
+      Commit the current atomic section and start a new one
+      """
+      with self.lock:
+        self.db.end_atomic ()
+        self.pending = 0
+        self.db.begin_atomic ()
+
+  class Writer:
+    """
+    Keeps the notmuch database open for writing and groups the changes into
+    atomic sections of (at least) `size` messages.
+
+    Use the writer as a context manager around the whole operation to keep the
+    database open across batches, and `batch ()` around the messages written
+    at a time:
+
+      with writer:
+        for ms in batches:
+          with writer.batch (len(ms)) as db:
+            ..
+
+    Nested use is allowed, the database is closed when the outermost context
+    exits. `flush ()` ends the current atomic section, after which the changes
+    are written to disk.
+
+    Writers of several repositories may share the database (see
+    SharedDatabase), a batch holds the database for the writer until it is
+    done.
+    """
+
+    def __init__ (self, local, size, shared = None):
+      self.local   = local
+      self.size    = max (1, size)
+      self.shared  = shared if shared is not None else Local.SharedDatabase ()
+      self.depth   = 0
+
+    @property
+    def db (self):
+      return self.shared.db
+
+    def __enter__ (self):
+      if self.depth == 0:
+        self.shared.open ()
+
+      self.depth += 1
+      return self
+
+    def __exit__ (self, *args):
+      self.depth -= 1
+
+      if self.depth == 0:
+        # also keep changes made before an error, the message files have
+        # already been written.
+        with self.shared.lock:
+          self.flush ()
+          self.shared.close ()
+
+    @contextmanager
+    def batch (self, n = 1):
+      """
+      Open database for writing `n` messages
+      """
+      with self:
+        with self.shared.lock:
+          yield self.shared.db
+
+          self.shared.pending += n
+          if self.shared.pending >= self.size:
+            self.flush ()
+
+    def flush (self):
+      """
+      Commit the current atomic section, if any
+      """
+      with self.shared.lock:
+        if self.shared.db is None:
+          return
+
+        # the message files must be on disk before notmuch and the
+        # repository state refer to them.
+        self.local.fsync ()
+
+        with self.local.stats.phase ('local.commit'):
+          self.shared.commit ()
+          self.local.index.commit ()
+
+  def __init__ (self, g, wd = None):
     self.gmailieer = g
-    self.wd = os.getcwd ()
+    self.wd = os.path.abspath (wd) if wd is not None else os.getcwd ()
     self.dry_run = g.dry_run
+    self.stats = g.stats
 
     # state file for local repository
     self.state_f = os.path.join (self.wd, '.gmailieer.json')
     self.credentials_f = os.path.join (self.wd, '.credentials.gmailieer.json')
+    self.index_f = os.path.join (self.wd, '.gmailieer.db')
 
     # mail store
     self.md = os.path.join (self.wd, 'mail')
 
+    # gids of the messages stored since the files were last flushed to disk
+    self.unsynced = []
+
   def load_repository (self):
     """
     Loads the current local repository
     """
+    import notmuch
 
     if not os.path.exists (self.state_f):
       raise Local.RepositoryException (
@@ -152,29 +725,6 @@ class Local:
       except notmuch.errors.FileError:
         raise Local.RepositoryException ("local mail repository not in notmuch db")
 
-    ## The Cache:
-    ##
-    ## this cache is used to know which messages we have a physical copy of.
-    ## hopefully this won't grow too gigantic with lots of messages.
-    self.files = []
-    for (dp, dirnames, fnames) in os.walk (os.path.join (self.md, 'cur')):
-      _fnames = ( 'cur/' + f for f in fnames )
-      self.files.extend (_fnames)
-      break
-
-    for (dp, dirnames, fnames) in os.walk (os.path.join (self.md, 'new')):
-      _fnames = ( 'new/' + f for f in fnames )
-      self.files.extend (_fnames)
-      break
-
-    # exclude files that are unlikely to be real message files
-    self.files = [ f for f in self.files if os.path.basename(f)[0] != '.' ]
-
-    self.gids = {}
-    for f in self.files:
-      m = os.path.basename(f).split (':')[0]
-      self.gids[m] = f
-
     # load notmuch config
     cfg = os.environ.get('NOTMUCH_CONFIG', os.path.expanduser('~/.notmuch-config'))
     if not os.path.exists (cfg):
@@ -187,8 +737,28 @@ class Local:
 
     self.loaded = True
 
+  @property
+  def index (self):
+    """
+    The cache of which messages we have a physical copy of, opened on first
+    use so that commands not needing it do not have to validate it.
+    """
+    if self._index is None:
+      self._index = Local.Index (self.index_f, self.md, self.dry_run)
+
+    return self._index
+
+  @property
+  def shadow (self):
+    """
+    The last known remote labels of the messages, see Local.Shadow.
+    """
+    if self._shadow is None:
+      self._shadow = Local.Shadow (self.index.db, self.dry_run)
+
+    return self._shadow
 
-  def initialize_repository(self, account, user_label_translation):
+  def initialize_repository(self, account, user_label_translation, adopt = False):
     """
     Sets up a local repository
     """
@@ -207,6 +777,7 @@ class Local:
     self.state = Local.State (self.state_f)
     self.state.account = account
     self.state.user_label_translation = user_label_translation
+    self.state.adopt = adopt
     self.state.write ()
     os.makedirs (os.path.join (self.md, 'cur'))
     os.makedirs (os.path.join (self.md, 'new'))
@@ -214,11 +785,16 @@ class Local:
 
   def has (self, m):
     """ Check whether we have message id """
-    return (m in self.gids)
+    return (m in self.index)
 
   def contains (self, fname):
     """ Check whether message file exists is in repository """
-    return ( Path(self.md) in Path(fname).parents )
+    return os.path.normpath (fname).startswith (self.md + os.sep)
+
+  def __relative_name__ (self, fname):
+    """ Maildir sub-directory and name of file, e.g. 'cur/gid:2,S' """
+    (d, name) = os.path.split (fname)
+    return os.path.basename (d) + '/' + name
 
   def __update_cache__ (self, nmsg, old = None):
     """
@@ -228,46 +804,52 @@ class Local:
       old  - tuple of old gid and old fname
     """
 
-    # remove old file from cache
+    new = [ self.__relative_name__ (_f) for _f in nmsg.get_filenames () if self.contains (_f) ]
+
     if old is not None:
       (old_gid, old_f) = old
+      old_f = self.__relative_name__ (old_f)
 
-      old_f = Path (old_f)
-      self.files.remove (os.path.join (old_f.parent.name, old_f.name))
-      self.gids.pop (old_gid)
+      if old_f in new:
+        # file was not renamed
+        new.remove (old_f)
 
-    # add message to cache
-    for _f in nmsg.get_filenames ():
-      if self.contains (_f):
-        new_f = Path (_f)
+      elif len(new) == 1 and new[0].startswith (old_gid + ':'):
+        # common case: maildir flags changed, file renamed in place
+        self.index.rename (old_f, new[0])
+        return
 
-        # there might be more GIDs (and files) for each NotmuchMessage, if so,
-        # the last matching file will be used in the gids map.
+      else:
+        # remove old file from cache
+        self.index.remove (old_f)
 
-        _m = new_f.name.split (':')[0]
-        self.gids[_m] = os.path.join (new_f.parent.name, new_f.name)
-        self.files.append (os.path.join (new_f.parent.name, new_f.name))
+    # add message to cache
+    for _f in new:
+      # there might be more GIDs (and files) for each NotmuchMessage, if so,
+      # the last matching file will be used in the gids map.
+      _m = _f.split ('/')[1].split (':')[0]
+      self.index.add (_m, _f)
 
-  def messages_to_gids (self, msgs):
-    """
-    Gets GIDs from a list of NotmuchMessages, the returned list of tuples may contain
-    the same NotmuchMessage several times for each matching file. Files outside the
-    repository are filtered out.
+  def messages_to_gids (self, msgs, snapshot = False):
     """
-    gids     = []
-    messages = []
+    Gets GIDs from an iterable of NotmuchMessages, yields tuples of
+    (NotmuchMessage, gid) as the messages are consumed. The same
+    NotmuchMessage may be yielded several times, once for each matching file.
+    Files outside the repository are filtered out.
 
+    With `snapshot` a Local.Snapshot of each message is yielded instead.
+    """
     for m in msgs:
+      if snapshot:
+        m = Local.Snapshot (m)
+
       for fname in m.get_filenames ():
         if not self.contains (fname):
           print ("'%s' is not in this repository, ignoring." % fname)
         else:
           # get gmail id
           gid = os.path.basename (fname).split (':')[0]
-          gids.append (gid)
-          messages.append (m)
-
-    return (messages, gids)
+          yield (m, gid)
 
 
   def __make_maildir_name__ (self, m, labels):
@@ -293,11 +875,27 @@ class Local:
 
     return p + info
 
+  def __locate__ (self, gid):
+    """
+    The file name of message `gid` in the maildir, or None if it is not
+    stored. If the file is gone (e.g. renamed by a mail client while we were
+    running) the index is brought up to date first.
+    """
+    fname = self.index.get (gid, None)
+    if fname is None or os.path.exists (os.path.join (self.md, fname)):
+      return fname
+
+    print ("local: %s has been moved, rescanning the maildir.." % fname)
+    self.stats.add ('index_rescans')
+    self.index.rescan ()
+
+    return self.index.get (gid, None)
+
   def remove (self, gid, db):
     """
     Remove message from local store
     """
-    fname  = self.gids.get (gid, None)
+    fname  = self.__locate__ (gid)
     ffname = fname
 
     if fname is None:
@@ -314,8 +912,98 @@ class Local:
         db.remove_message (fname)
       os.unlink (fname)
 
-      self.files.remove (ffname)
-      self.gids.pop (gid)
+      self.index.remove (ffname)
+      self.shadow.remove (gid)
+
+    self.stats.add ('messages_removed')
+
+  @staticmethod
+  def __write_raw__ (raw, fd, crlf = True, stats = None):
+    """
+    Decode the base64url encoded message `raw` into the file `fd`,
+    DECODE_CHUNK characters at the time so that the decoded message is never
+    held in memory as a whole. Line endings are converted to '\\n' unless
+    `crlf`.
+
+    The time spent decoding and writing the chunks is added up, and recorded
+    to `stats` (if given) as the local.decode and local.write phases.
+
+    Returns the number of bytes written.
+    """
+    n  = 0
+    cr = False # the previous chunk ended in '\r'
+
+    decode = 0
+    write  = 0
+
+    for i in range (0, len(raw), Local.DECODE_CHUNK):
+      t0 = time.perf_counter ()
+      b  = base64.urlsafe_b64decode (raw[i:i + Local.DECODE_CHUNK])
+      c  = b''
+
+      if not crlf:
+        if cr and not b.startswith (b'\n'):
+          c = b'\r'
+
+        # a line ending may be split between chunks
+        cr = b.endswith (b'\r')
+        b  = b.replace (b'\r\n', b'\n')
+        if cr:
+          b = b[:-1]
+
+      t1 = time.perf_counter ()
+      if c:
+        n += fd.write (c)
+      n += fd.write (b)
+
+      decode += t1 - t0
+      write  += time.perf_counter () - t1
+
+    if cr:
+      n += fd.write (b'\r')
+
+    if stats is not None:
+      stats.record ('local.decode', decode)
+      stats.record ('local.write', write)
+
+    return n
+
+  @staticmethod
+  def __fsync_dir__ (d):
+    fd = os.open (d, os.O_RDONLY)
+    try:
+      os.fsync (fd)
+    finally:
+      os.close (fd)
+
+  def fsync (self):
+    """
+    Flush the message files stored since the last time, and the directory
+    they were stored in, to disk (with the batch durability).
+    """
+    if not self.unsynced:
+      return
+
+    with self.stats.phase ('local.fsync'):
+      for gid in self.unsynced:
+        # the file may have been renamed when the maildir flags were set
+        fname = self.index.get (gid, None)
+        if fname is None:
+          continue
+
+        try:
+          fd = os.open (os.path.join (self.md, fname), os.O_RDONLY)
+        except FileNotFoundError:
+          continue
+
+        try:
+          os.fsync (fd)
+        finally:
+          os.close (fd)
+
+      self.__fsync_dir__ (os.path.join (self.md, 'cur'))
+
+    self.unsynced = []
 
   def store (self, m, db):
     """
@@ -323,19 +1011,12 @@ class Local:
     """
 
     gid     = m['id']
-    msg_str = base64.urlsafe_b64decode(m['raw'].encode ('ASCII'))
-
-    # messages from GMail have windows line endings
-    if os.linesep == '\n':
-      msg_str = msg_str.replace (b'\r\n', b'\n')
-
     labels  = m.get('labelIds', [])
 
     bname = self.__make_maildir_name__(gid, labels)
 
     # add to cache
-    self.files.append (os.path.join ('cur', bname))
-    self.gids[gid] = os.path.join ('cur', bname)
+    self.index.add (gid, os.path.join ('cur', bname))
 
     p       = os.path.join (self.md, 'cur', bname)
     tmp_p   = os.path.join (self.md, 'tmp', bname)
@@ -348,41 +1029,118 @@ class Local:
 
     if not self.dry_run:
       with open (tmp_p, 'wb') as fd:
-        fd.write (msg_str)
+        # messages from GMail have windows line endings
+        self.__write_raw__ (m['raw'], fd, os.linesep != '\n', self.stats)
+
+        if self.state.durability == 'file':
+          with self.stats.phase ('local.fsync'):
+            fd.flush ()
+            os.fsync (fd.fileno ())
 
       os.rename (tmp_p, p)
 
+      if self.state.durability == 'file':
+        with self.stats.phase ('local.fsync'):
+          self.__fsync_dir__ (os.path.join (self.md, 'cur'))
+
+      elif self.state.durability == 'batch':
+        self.unsynced.append (gid)
+
+    # the content is not needed anymore, do not keep it around until the
+    # rest of the batch has been stored.
+    del m['raw']
+
+    self.stats.add ('messages_stored')
+
     # add to notmuch
     self.update_tags (m, p, db)
 
+  def adopt (self, m, src, db):
+    """
+    Store message `m` (with its metadata only) using the file `src` of the
+    same message that is already in notmuch, outside of the repository. The
+    file is hard linked into the repository if possible, otherwise copied.
+    """
+    gid     = m['id']
+    labels  = m.get('labelIds', [])
+
+    bname = self.__make_maildir_name__(gid, labels)
+
+    self.index.add (gid, os.path.join ('cur', bname))
+
+    p       = os.path.join (self.md, 'cur', bname)
+    tmp_p   = os.path.join (self.md, 'tmp', bname)
+
+    if os.path.exists (p):
+      raise Local.RepositoryException ("local file already exists: %s" % p)
+
+    if os.path.exists (tmp_p):
+      raise Local.RepositoryException ("local file already exists: %s" % p)
+
+    if self.dry_run:
+      print ("(dry-run) adopting message: %s: %s" % (gid, src))
+      return
+
+    with self.stats.phase ('local.write'):
+      try:
+        os.link (src, tmp_p)
+      except OSError:
+        # on another file system
+        shutil.copyfile (src, tmp_p)
+
+        if self.state.durability == 'file':
+          with open (tmp_p, 'rb') as fd:
+            os.fsync (fd.fileno ())
+
+      os.rename (tmp_p, p)
+
+    if self.state.durability == 'file':
+      with self.stats.phase ('local.fsync'):
+        self.__fsync_dir__ (os.path.join (self.md, 'cur'))
+
+    elif self.state.durability == 'batch':
+      self.unsynced.append (gid)
+
+    self.stats.add ('messages_adopted')
+
+    # the file is added to the existing message, whose tags are then set from
+    # the labels like for any message that is already stored.
+    self.__index_file__ (p, db)
+    self.update_tags (m, p, db)
+
+  def __index_file__ (self, fname, db):
+    import notmuch
+
+    with self.stats.phase ('local.index'):
+      if hasattr (notmuch.Database, 'index_file'):
+        return db.index_file (fname, True)
+      else:
+        return db.add_message (fname, True)
+
   def update_tags (self, m, fname, db):
     # make sure notmuch tags reflect gmail labels
     gid = m['id']
     glabels = m.get('labelIds', [])
 
+    # remember the labels of the message on the remote, for push
+    self.shadow.set (gid, int(m.get ('historyId', 0)), glabels)
+
     # translate labels. Remote.get_labels () must have been called first
-    labels = []
-    for l in glabels:
-      ll = self.gmailieer.remote.labels.get(l, None)
-
-      if ll is None and not self.state.drop_non_existing_label:
-        err = "error: GMail supplied a label that there exists no record for! You can `gmi set --drop-non-existing-labels` to work around the issue (https://github.com/gauteh/gmailieer/issues/48)"
-        print (err)
-        raise Local.RepositoryException (err)
-      elif ll is None:
-        pass # drop
-      else:
-        labels.append (ll)
+    labels = self.gmailieer.remote.labels_to_tags (glabels)
 
-    # remove ignored labels
-    labels = set(labels)
-    labels = list(labels - self.gmailieer.remote.ignore_labels)
-    labels = self.gmailieer.label_translator.remote_labels_to_local(labels)
+    if labels is None:
+      err = "error: GMail supplied a label that there exists no record for! You can `gmi set --drop-non-existing-labels` to work around the issue (https://github.com/gauteh/gmailieer/issues/48)"
+      print (err)
+      raise Local.RepositoryException (err)
 
     if fname is None:
       # this file hopefully already exists and just needs it tags updated,
       # let's try to find its name in the gid to fname table.
-      fname = os.path.join (self.md, self.gids[gid])
+      fname = self.__locate__ (gid)
+      if fname is None:
+        raise KeyError (gid)
+
+      fname = os.path.join (self.md, fname)
 
     else:
       # new file
@@ -398,13 +1156,11 @@ class Local:
 
     if nmsg is None:
       if self.dry_run:
-        print ("(dry-run) adding message: %s: %s, with tags: %s" % (gid, fname, str(labels)))
+        print ("(dry-run) adding message: %s: %s, with tags: %s" % (gid, fname, str(sorted (labels))))
       else:
+        import notmuch
         try:
-          if hasattr (notmuch.Database, 'index_file'):
-            (nmsg, stat) = db.index_file (fname, True)
-          else:
-            (nmsg, stat) = db.add_message (fname, True)
+          (nmsg, stat) = self.__index_file__ (fname, db)
         except notmuch.errors.FileNotEmailError:
           print('%s is not an email' % fname)
           return True
@@ -428,23 +1184,25 @@ class Local:
       otags   = set(nmsg.get_tags ())
       igntags = otags & self.ignore_labels
       otags   = otags - self.ignore_labels # remove ignored tags while checking
-      if otags != set (labels):
-        labels.extend (igntags) # add back local ignored tags before adding
+      if otags != labels:
+        labels = labels | igntags # add back local ignored tags before adding
         if not self.dry_run:
-          nmsg.freeze ()
+          with self.stats.phase ('local.tags'):
+            nmsg.freeze ()
 
-          nmsg.remove_all_tags ()
-          for t in labels:
-            nmsg.add_tag (t, False)
+            nmsg.remove_all_tags ()
+            for t in labels:
+              nmsg.add_tag (t, False)
 
-          nmsg.thaw ()
+            nmsg.thaw ()
 
-          nmsg.tags_to_maildir_flags ()
-          self.__update_cache__ (nmsg, (gid, fname))
+            nmsg.tags_to_maildir_flags ()
+            self.__update_cache__ (nmsg, (gid, fname))
 
         else:
-          print ("(dry-run) changing tags on message: %s from: %s to: %s" % (gid, str(otags), str(labels)))
+          print ("(dry-run) changing tags on message: %s from: %s to: %s" % (gid, str(otags), str(sorted (labels))))
 
+        self.stats.add ('messages_tags_changed')
         return True
       else:
         return False
@@ -0,0 +1,188 @@
+import time
+import threading
+from contextlib import contextmanager
+
+class RateController:
+  """
+  Paces all requests to the GMail API of an account.
+
+  Requests take quota units from a token bucket which is refilled at `rate`
+  units per second. The rate, the batch size and the number of concurrent
+  requests are adapted additively-increase / multiplicatively-decrease: they
+  are cut down when GMail signals that we are going too fast (or a batch fails)
+  and grown step by step again as requests succeed, so that a transient error
+  does not slow down the rest of the synchronization.
+
+  After a failure all requests are held back for `delay` seconds, the delay
+  doubles with every consecutive failure and is halved again after
+  `RECOVERY` successful requests.
+
+  The controller is thread safe, and is shared by all requests of a Remote.
+  Remotes of several accounts synchronized at once may also share a `budget`:
+  a semaphore of which every request holds one slot, limiting the number of
+  concurrent requests over all the accounts.
+
+  * https://developers.google.com/gmail/api/reference/quota
+  """
+
+  # quota units used by each method
+  COSTS = {
+      'labels.list'          : 1,
+      'labels.create'        : 5,
+      'history.list'         : 2,
+      'messages.list'        : 5,
+      'messages.get'         : 5,
+      'messages.modify'      : 5,
+      'messages.batchModify' : 50,
+      }
+
+  DEFAULT_COST = 5
+
+  # per user rate limit (units per second, moving average)
+  MAX_RATE  = 250
+  MIN_RATE  = 10
+  RATE_STEP = 10
+
+  # successful requests before the delay is reduced and the batch size and
+  # concurrency are grown again.
+  RECOVERY  = 10
+
+  def __init__ (self, batch_size, min_batch_size = 1, concurrency = 1, budget = None):
+    self.lock   = threading.Condition ()
+    self.budget = budget
+
+    self.rate       = self.MAX_RATE
+    self.tokens     = self.MAX_RATE
+    self.refilled   = time.monotonic ()
+
+    self.delay      = 0
+    self.resume_at  = 0
+    self.ok         = 0
+
+    self.max_batch_size = batch_size
+    self.min_batch_size = min_batch_size
+    self.batch_size     = batch_size
+
+    self.max_concurrency = concurrency
+    self.concurrency     = concurrency
+    self.active          = 0
+
+  def set_max_concurrency (self, n):
+    with self.lock:
+      self.max_concurrency = max (1, n)
+      self.concurrency     = self.max_concurrency
+      self.lock.notify_all ()
+
+  def cost (self, method, n = 1):
+    return self.COSTS.get (method, self.DEFAULT_COST) * n
+
+  def __refill__ (self):
+    now = time.monotonic ()
+    # allow short bursts of up to two seconds worth of quota
+    self.tokens   = min (2 * self.rate, self.tokens + (now - self.refilled) * self.rate)
+    self.refilled = now
+
+  def acquire (self, method, n = 1):
+    """
+    Wait until `n` requests of `method` may be made
+
+    Returns the number of seconds waited.
+    """
+    units  = self.cost (method, n)
+    waited = 0
+
+    with self.lock:
+      while True:
+        now = time.monotonic ()
+        if now < self.resume_at:
+          wait = self.resume_at - now
+
+        else:
+          self.__refill__ ()
+
+          # a request larger than the bucket is let through when the bucket is
+          # full, running into debt.
+          if self.tokens >= min (units, 2 * self.rate):
+            self.tokens -= units
+            return waited
+
+          wait = (min (units, 2 * self.rate) - self.tokens) / self.rate
+
+        self.lock.wait (wait)
+        waited += time.monotonic () - now
+
+  def success (self):
+    """
+    A request or batch succeeded
+    """
+    with self.lock:
+      self.rate = min (self.MAX_RATE, self.rate + self.RATE_STEP)
+      self.ok  += 1
+
+      if self.ok >= self.RECOVERY:
+        self.ok = 0
+
+        self.delay       = self.delay // 2
+        self.batch_size  = min (self.max_batch_size, self.batch_size + max (1, self.max_batch_size // 10))
+
+        if self.concurrency < self.max_concurrency:
+          self.concurrency += 1
+          self.lock.notify_all ()
+
+  def backoff (self, rate_limited = True):
+    """
+    A request failed: hold back all requests for an increasing delay. If the
+    request was rejected because of the rate limit, the rate and concurrency
+    are reduced as well.
+
+    Returns the new delay.
+    """
+    with self.lock:
+      self.delay     = self.delay * 2 + 1
+      self.ok        = 0
+      self.resume_at = time.monotonic () + self.delay
+
+      if rate_limited:
+        self.rate        = max (self.MIN_RATE, self.rate / 2)
+        self.tokens      = min (self.tokens, self.rate)
+        self.concurrency = max (1, self.concurrency // 2)
+
+      return self.delay
+
+  def reduce_batch_size (self):
+    """
+    A batch failed, use smaller batches
+
+    Returns False if the batch size cannot be reduced any further.
+    """
+    with self.lock:
+      if self.batch_size <= self.min_batch_size:
+        return False
+
+      self.batch_size = max (self.min_batch_size, self.batch_size // 2)
+      self.ok = 0
+      return True
+
+  @contextmanager
+  def slot (self):
+    """
+    Hold one of the currently allowed concurrent requests
+    """
+    with self.lock:
+      while self.active >= self.concurrency:
+        self.lock.wait ()
+      self.active += 1
+
+    if self.budget is not None:
+      self.budget.acquire ()
+
+    try:
+      yield
+
+    finally:
+      if self.budget is not None:
+        self.budget.release ()
+
+      with self.lock:
+        self.active -= 1
+        self.lock.notify_all ()
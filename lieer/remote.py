@@ -1,6 +1,14 @@
 import os
+import json
+import socket
 import time
+import tempfile
+import threading
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import httplib2
+from http.client import HTTPResponse
 import googleapiclient
 from apiclient import discovery
 from oauth2client import client
@@ -8,6 +16,8 @@ from oauth2client import tools
 from oauth2client.file import Storage
 from pathlib import Path
 
+from .ratecontrol import RateController
+
 class Remote:
   SCOPES = 'https://www.googleapis.com/auth/gmail.readonly https://www.googleapis.com/auth/gmail.labels https://www.googleapis.com/auth/gmail.modify'
   APPLICATION_NAME   = 'Gmailieer'
@@ -68,9 +78,7 @@ class Remote:
   # used to indicate whether all messages that should be updated where updated
   all_updated = True
 
-  # Handle exponential back-offs in non-batch requests.
-  _delay     = 0
-  _delay_ok  = 0
+  # Give up when the delay between requests grows beyond this (seconds).
   MAX_DELAY  = 100
   MAX_CONNECTION_ERRORS = 20
 
@@ -82,6 +90,36 @@ class Remote:
   BATCH_REQUEST_SIZE     = 50
   MIN_BATCH_REQUEST_SIZE = 1
 
+  ## Message ids in each page when listing the messages of a label (at most 500)
+  LIST_PAGE_SIZE = 500
+
+  ## Batches of raw messages are also limited by the (estimated) size of the
+  ## messages, so that a batch of large messages does not time out or take up
+  ## lots of memory. Messages larger than SINGLE_REQUEST_BYTES are fetched by
+  ## themselves. The size of a message is its sizeEstimate if it is known,
+  ## otherwise a moving average of the messages received so far. When a batch
+  ## fails or times out the sizeEstimate of its messages is looked up, and
+  ## they are packed again.
+  BATCH_BYTES          = 10 * 1024 * 1024
+  SINGLE_REQUEST_BYTES = 5 * 1024 * 1024
+  DEFAULT_MESSAGE_SIZE = 75 * 1024
+  SIZE_EWMA            = 0.1
+
+  ## Messages getting the same label changes are pushed together with
+  ## messages.batchModify, which takes up to 1000 ids. It costs as much quota
+  ## as 10 messages.modify requests, smaller groups are modified one by one.
+  BATCH_MODIFY_SIZE      = 1000
+  MIN_BATCH_MODIFY       = 10
+
+  ## The discovery document describing the API is cached, and re-fetched when
+  ## it is older than DISCOVERY_TTL seconds.
+  DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/gmail/v1/rest'
+  DISCOVERY_TTL = 24 * 3600
+
+  ## Makes the Http objects of the connections to GMail (Remote.Http if None),
+  ## see Remote.Transport.
+  http_factory = None
+
   class BatchException (Exception):
     pass
 
@@ -94,6 +132,104 @@ class Remote:
   class NoHistoryException (Exception):
     pass
 
+  class Http (httplib2.Http):
+    """
+    Asks for compressed responses and counts the bytes received
+
+    GMail only compresses the responses to clients that say so in the
+    user agent as well as in accept-encoding. The client library does this for
+    single requests, but not for the batch requests.
+
+    The bytes of the response bodies are counted as they are read from the
+    connection, before httplib2 decompresses them (`bytes`), and after
+    (`bytes_decoded`).
+    """
+    USER_AGENT = 'gmailieer (gzip)'
+
+    def __init__ (self, stats, **kwargs):
+      super ().__init__ (**kwargs)
+      self.stats = stats
+
+      class Response (HTTPResponse):
+        def read (self, amt = None):
+          b = super ().read (amt)
+          stats.add ('bytes', len(b))
+          return b
+
+      self.connection_types = {
+          'http'  : type ('HTTPConnection', (httplib2.HTTPConnectionWithTimeout,),
+                          { 'response_class' : Response }),
+          'https' : type ('HTTPSConnection', (httplib2.HTTPSConnectionWithTimeout,),
+                          { 'response_class' : Response }),
+          }
+
+    def request (self, uri, method = 'GET', body = None, headers = None,
+                 redirections = httplib2.DEFAULT_MAX_REDIRECTS, connection_type = None):
+      headers = dict ((k.lower (), v) for (k, v) in (headers or {}).items ())
+
+      ua = headers.get ('user-agent', None)
+      if ua is None:
+        headers['user-agent'] = self.USER_AGENT
+      elif 'gzip' not in ua:
+        headers['user-agent'] = ua + ' (gzip)'
+
+      if 'gzip' not in headers.get ('accept-encoding', ''):
+        headers['accept-encoding'] = 'gzip, deflate'
+
+      if connection_type is None:
+        connection_type = self.connection_types.get (uri.split (':', 1)[0].lower ())
+
+      (resp, content) = super ().request (uri, method, body, headers, redirections, connection_type)
+      if content is not None:
+        self.stats.add ('bytes_decoded', len(content))
+      if resp.get ('-content-encoding', None) == 'gzip':
+        self.stats.add ('compressed_responses')
+      return (resp, content)
+
+  class Transport:
+    """
+    The connections to GMail: a pool of authorized Http objects, each
+    keeping its connection alive between requests. httplib2.Http is not
+    thread safe, so a connection is used by one thread at the time and put
+    back in the pool afterwards, to be reused by the next request from any
+    thread.
+
+    `factory (stats, timeout = ..)` makes the unauthorized Http objects,
+    Remote.Http by default.
+    """
+    def __init__ (self, credentials, stats, timeout = None, factory = None):
+      self.credentials = credentials
+      self.stats       = stats
+      self.timeout     = timeout
+      self.factory     = factory if factory is not None else Remote.Http
+
+      self.lock = threading.Lock ()
+      self.idle = []
+
+    def new (self):
+      """
+      A new authorized connection, not part of the pool
+      """
+      self.stats.add ('connections')
+      return self.credentials.authorize (self.factory (self.stats, timeout = self.timeout))
+
+    @contextmanager
+    def connection (self):
+      """
+      Check out a connection from the pool
+      """
+      with self.lock:
+        http = self.idle.pop () if self.idle else None
+
+      if http is None:
+        http = self.new ()
+
+      try:
+        yield http
+      finally:
+        with self.lock:
+          self.idle.append (http)
+
   def __init__ (self, g):
     self.gmailieer = g
 
@@ -102,6 +238,27 @@ class Remote:
     self.CLIENT_SECRET_FILE = g.credentials_file
     self.account = g.local.state.account
     self.dry_run = g.dry_run
+    self.stats   = g.stats
+
+    # label ids that are not known even after re-fetching the labels
+    self.missing_labels = set ()
+
+    # the current historyId of the mailbox, as returned by the last listing
+    # of the history.
+    self.current_history_id = None
+
+    # the sizeEstimate of messages that are yet to be downloaded, and the
+    # average size of the messages downloaded.
+    self.sizes        = {}
+    self.message_size = self.DEFAULT_MESSAGE_SIZE
+
+    xdg_cache_home = os.getenv ('XDG_CACHE_HOME', os.path.expanduser ('~/.cache'))
+    self.discovery_f = os.path.join (xdg_cache_home, 'gmailieer', 'gmail-v1.json')
+
+    # shared by all requests to the account, and the budget of concurrent
+    # requests by all accounts (see sync-all)
+    self.rate = RateController (self.BATCH_REQUEST_SIZE, self.MIN_BATCH_REQUEST_SIZE,
+                                budget = g.budget)
 
   def __require_auth__ (func):
     def func_wrap (self, *args, **kwargs):
@@ -110,33 +267,68 @@ class Remote:
       return func (self, *args, **kwargs)
     return func_wrap
 
-  def __wait_delay__ (self):
-    if self._delay:
-      time.sleep (self._delay)
+  @property
+  def jobs (self):
+    """ Number of concurrent batch requests when fetching messages """
+    return self.rate.max_concurrency
+
+  @jobs.setter
+  def jobs (self, n):
+    self.rate.set_max_concurrency (n)
 
-  def __request_done__ (self, success):
+  def __request_done__ (self, success, rate_limited = True):
     if success:
-      if self._delay:
-        if self._delay_ok > 10:
-          # after 10 good requests, reduce request delay
-          self._delay    = self._delay // 2
-          self._delay_ok = 0
-        else:
-          self._delay_ok += 1
+      self.rate.success ()
     else:
-      self._delay    = self._delay * 2 + 1
-      self._delay_ok = 0
-      if self._delay <= self.MAX_DELAY:
-        print ("remote: request failed, increasing delay between requests to: %d s" % self._delay)
+      delay = self.rate.backoff (rate_limited)
+      if delay <= self.MAX_DELAY:
+        print ("remote: request failed, increasing delay between requests to: %d s" % delay)
       else:
         print ("remote: increased delay to more than maximum of %d s." % self.MAX_DELAY)
         raise Remote.GenericException ("cannot increase delay more to more than maximum %d s" % self.MAX_DELAY)
 
+  def __acquire__ (self, method, n = 1):
+    """
+    Wait for quota for `n` requests of `method`
+    """
+    self.stats.add ('sleep_seconds', self.rate.acquire (method, n))
+    self.stats.add ('requests', n)
+    self.stats.add ('quota_units', self.rate.cost (method, n))
 
+  def __execute__ (self, method, request, http = None):
+    """
+    Execute a single request, retrying with back-off when we are rate limited
+    or the server fails. The request is made with `http` if given, otherwise
+    the connection of the service.
+    """
+    while True:
+      self.__acquire__ (method)
+
+      try:
+        with self.rate.slot ():
+          with self.stats.phase ('remote.' + method):
+            result = request.execute (http = http)
+
+      except googleapiclient.errors.HttpError as excep:
+        if excep.resp.status in (403, 429):
+          self.stats.add ('retries')
+          self.__request_done__ (False)
+          continue
+
+        elif excep.resp.status in (500, 503):
+          self.stats.add ('retries')
+          self.__request_done__ (False, False)
+          continue
+
+        else:
+          raise
+
+      self.__request_done__ (True)
+      return result
 
   @__require_auth__
   def get_labels (self):
-    results = self.service.users ().labels ().list (userId = self.account).execute ()
+    results = self.__execute__ ('labels.list', self.service.users ().labels ().list (userId = self.account))
     labels = results.get ('labels', [])
 
     self.labels     = {}
@@ -145,15 +337,59 @@ class Remote:
       self.labels[l['id']]      = l['name']
       self.invlabels[l['name']] = l['id']
 
+    self.gmailieer.label_translator.compile (self.labels, self.ignore_labels)
+
     return self.labels
 
+  def get_label (self, lid):
+    """
+    Get the name of a label id. If the label is not known the labels are
+    fetched again, it may have been created since they were last fetched.
+    """
+    l = self.labels.get (lid, None)
+    if l is None and lid not in self.missing_labels:
+      self.get_labels ()
+      l = self.labels.get (lid, None)
+      if l is None:
+        self.missing_labels.add (lid)
+
+    return l
+
+  def labels_to_tags (self, glabels):
+    """
+    Translate the label ids of a message to notmuch tags, leaving out the
+    ignored labels. Remote.get_labels () must have been called first.
+
+    Returns a frozenset of tags, or None if a label does not exist (and
+    non-existing labels are not dropped).
+    """
+    tags = self.gmailieer.label_translator.label_ids_to_local (glabels)
+    if tags is not None:
+      return tags
+
+    # some label is not known, it may have been created since the labels
+    # were fetched.
+    labels = set ()
+    for l in glabels:
+      ll = self.get_label (l)
+
+      if ll is None and not self.gmailieer.local.state.drop_non_existing_label:
+        return None
+      elif ll is None:
+        pass # drop
+      else:
+        labels.add (ll)
+
+    labels = labels - self.ignore_labels
+    return frozenset (self.gmailieer.label_translator.remote_labels_to_local (labels))
+
   @__require_auth__
   def get_current_history_id (self, start):
     """
     Get the current history id of the mailbox
     """
     try:
-      results = self.service.users ().history ().list (userId = self.account, startHistoryId = start).execute ()
+      results = self.__execute__ ('history.list', self.service.users ().history ().list (userId = self.account, startHistoryId = start))
       if 'historyId' in results:
         return int(results['historyId'])
       else:
@@ -163,7 +399,7 @@ class Remote:
       # this happens if the original historyId is too old,
       # try to get last message and the historyId from it.
       for mset in self.all_messages (1):
-        (total, mset) = mset
+        (total, mset, _) = mset
         m     = mset[0]
         msg   = self.get_message (m['id'])
         return int(msg['historyId'])
@@ -172,11 +408,15 @@ class Remote:
   def get_history_since (self, start):
     """
     Get all changes since start historyId
+
+    The current historyId of the mailbox is available in
+    `current_history_id` once the first page has been received.
     """
-    self.__wait_delay__ ()
-    results = self.service.users ().history ().list (userId = self.account, startHistoryId = start).execute ()
+    results = self.__execute__ ('history.list', self.service.users ().history ().list (userId = self.account, startHistoryId = start))
+    if 'historyId' in results:
+      self.current_history_id = int(results['historyId'])
+
     if 'history' in results:
-      self.__request_done__ (True)
       yield results['history']
 
     # no history field means that there is no history
@@ -184,11 +424,9 @@ class Remote:
     while 'nextPageToken' in results:
       pt = results['nextPageToken']
 
-      self.__wait_delay__ ()
-      _results = self.service.users ().history ().list (userId = self.account, startHistoryId = start, pageToken = pt).execute ()
+      _results = self.__execute__ ('history.list', self.service.users ().history ().list (userId = self.account, startHistoryId = start, pageToken = pt))
 
       if 'history' in _results:
-        self.__request_done__ (True)
         results = _results
         yield results['history']
       else:
@@ -197,70 +435,214 @@ class Remote:
         raise Remote.NoHistoryException ()
 
   @__require_auth__
-  def all_messages (self, limit = None):
+  def get_changed_since (self, start):
+    """
+    Get the ids of all messages that have changed since start historyId
+    """
+    gids = set ()
+    for hist in self.get_history_since (start):
+      for h in hist:
+        for m in h.get ('messages', []):
+          gids.add (m['id'])
+
+    return gids
+
+  @__require_auth__
+  def label_messages (self, lid):
     """
-    Get a list of all messages
+    Get the ids of all messages with the label `lid`, yields a list of ids
+    for each page of the listing.
     """
+    pt = None
+
+    while True:
+      results = self.__execute__ ('messages.list', self.service.users ().messages ().list (userId = self.account, labelIds = [ lid ], pageToken = pt, q = self.query, maxResults = self.LIST_PAGE_SIZE, includeSpamTrash = True))
 
-    self.__wait_delay__ ()
-    results = self.service.users ().messages ().list (userId = self.account, q = self.query, maxResults = limit, includeSpamTrash = True).execute ()
+      yield [ m['id'] for m in results.get ('messages', []) ]
+
+      pt = results.get ('nextPageToken')
+      if pt is None:
+        break
+
+  @__require_auth__
+  def all_messages (self, limit = None, start = None):
+    """
+    Get a list of all messages, optionally continuing from the page token
+    `start`.
+
+    Yields tuples of (estimated total, messages, token of next page), the
+    token is None for the last page.
+    """
+
+    results = self.__execute__ ('messages.list', self.service.users ().messages ().list (userId = self.account, pageToken = start, q = self.query, maxResults = limit, includeSpamTrash = True))
 
     if 'messages' in results:
-      self.__request_done__ (True)
-      yield (results['resultSizeEstimate'], results['messages'])
+      yield (results['resultSizeEstimate'], results['messages'], results.get ('nextPageToken'))
 
     # no messages field presumably means no messages
 
     while 'nextPageToken' in results:
       pt = results['nextPageToken']
-      _results = self.service.users ().messages ().list (userId = self.account, pageToken = pt, q = self.query, maxResults = limit, includeSpamTrash = True).execute ()
+      _results = self.__execute__ ('messages.list', self.service.users ().messages ().list (userId = self.account, pageToken = pt, q = self.query, maxResults = limit, includeSpamTrash = True))
 
       if 'messages' in _results:
-        self.__request_done__ (True)
         results = _results
-        yield (results['resultSizeEstimate'], results['messages'])
+        yield (results['resultSizeEstimate'], results['messages'], results.get ('nextPageToken'))
       else:
-        self.__request_done__ (True)
         print ("remote: warning: no messages when several pages were indicated.")
         break
 
   @__require_auth__
-  def get_messages (self, gids, cb, format):
+  def get_messages (self, gids, cb, format, headers = None):
+    """
+    Get the messages, with only the `headers` with the 'metadata' format
+
+    With more than one job the batches are fetched concurrently, each worker
+    using a connection from the pool, while `cb` is only ever called from the calling
+    thread. The batches are handed to `cb` in the same order as `gids`.
+    """
+
+    if self.jobs <= 1 or len (gids) <= self.BATCH_REQUEST_SIZE:
+      self.__get_messages__ (gids, cb, format, self.http, headers)
+      return
+
+    def _fetch (chunk):
+      msgs = []
+      with self.transport.connection () as http:
+        self.__get_messages__ (chunk, msgs.extend, format, http, headers)
+      return msgs
+
+    # at most 2 * jobs batches are in flight or waiting for `cb`, this keeps
+    # memory bounded when storing the messages is slower than fetching them.
+    with ThreadPoolExecutor (max_workers = self.jobs) as pool:
+      pending = deque ()
+
+      def _deliver ():
+        msgs = pending.popleft ().result ()
+        if len(msgs) > 0:
+          cb (msgs)
+
+      try:
+        for i in range (0, len (gids), self.BATCH_REQUEST_SIZE):
+          pending.append (pool.submit (_fetch, gids[i:i + self.BATCH_REQUEST_SIZE]))
+
+          if len (pending) >= 2 * self.jobs:
+            _deliver ()
+
+        while pending:
+          _deliver ()
+
+      except:
+        for f in pending:
+          f.cancel ()
+        raise
+
+  def __message_size__ (self, gid):
+    return self.sizes.get (gid, self.message_size)
+
+  def __got_raw__ (self, ms):
+    """
+    Learn the size of messages from the raw messages received
+    """
+    for m in ms:
+      self.sizes.pop (m['id'], None)
+      size = len (m.get ('raw', '')) * 3 // 4
+      self.message_size += self.SIZE_EWMA * (size - self.message_size)
+
+  def __lookup_sizes__ (self, gids, http):
+    """
+    Get the sizeEstimate of the messages in `gids` whose size is not known.
+    Returns False if they were all known.
+    """
+    unknown = [ gid for gid in gids if gid not in self.sizes ]
+    if len(unknown) == 0:
+      return False
+
+    def _request (gid):
+      return self.service.users ().messages ().get (userId = self.account,
+          id = gid, format = 'minimal', fields = 'id,sizeEstimate')
+
+    def _cb (ms):
+      for m in ms:
+        if 'sizeEstimate' in m:
+          self.sizes[m['id']] = m['sizeEstimate']
+
+    self.stats.add ('size_lookups', len(unknown))
+    self.__execute_batches__ ('messages.get', unknown, _request, lambda gid: gid, _cb, http)
+
+    # not looked up again if they could not be found
+    for gid in unknown:
+      self.sizes.setdefault (gid, self.message_size)
+
+    return True
+
+  def __get_messages__ (self, gids, cb, format, http, headers = None):
+    """
+    Get the messages in batches using `http`, calling `cb` with the
+    messages received in each batch.
+    """
+
+    def _request (gid):
+      if headers is not None:
+        return self.service.users ().messages ().get (userId = self.account,
+            id = gid, format = format, metadataHeaders = headers)
+
+      return self.service.users ().messages ().get (userId = self.account,
+          id = gid, format = format)
+
+    if format == 'raw':
+      # batches are packed by the size of the messages
+      def _cb (ms):
+        self.__got_raw__ (ms)
+        cb (ms)
+
+      self.__execute_batches__ ('messages.get', gids, _request, lambda gid: gid, _cb, http,
+                                self.__message_size__, self.__lookup_sizes__)
+
+    else:
+      self.__execute_batches__ ('messages.get', gids, _request, lambda gid: gid, cb, http)
+
+  def __execute_batches__ (self, method, items, request, gid, cb, http, size = None, lookup = None):
     """
-    Get the messages
+    Execute the requests for `items` in batches using `http`, calling `cb`
+    with the responses received in each batch.
+
+      method  - API method, for the quota
+      request - function making the request for an item
+      gid     - function giving the message id of an item, for errors
+      size    - function giving the estimated size of the response for an
+                item, batches are then limited to BATCH_BYTES and items
+                larger than SINGLE_REQUEST_BYTES are requested by themselves
+      lookup  - function (items, http) learning the sizes of the items of a
+                batch that failed, returns False if there was nothing to learn
+                (the batch size is then reduced instead)
     """
 
-    max_req = self.BATCH_REQUEST_SIZE
-    N       = len (gids)
+    N       = len (items)
     i       = 0
     j       = 0
 
-    # How much to wait before contacting the remote.
-    user_rate_delay     = 0
-    # How many requests with the current delay returned ok.
-    user_rate_ok        = 0
+    conn_errors = 0
 
-    conn_errors         = 0
-
-    msg_batch = [] # queue up received batch and send in one go to content / db routine
+    responses = [] # queue up received batch and send in one go to content / db routine
 
     def _cb (rid, resp, excep):
-      nonlocal j, msg_batch
+      nonlocal j
       if excep is not None:
         if type(excep) is googleapiclient.errors.HttpError and excep.resp.status == 404:
           # message could not be found this is probably a deleted message, spam or draft
           # message since these are not included in the messages.get() query by default.
-          print ("remote: could not find remote message: %s!" % gids[j])
+          print ("remote: could not find remote message: %s!" % gid (items[j]))
           j += 1
           return
 
         elif type(excep) is googleapiclient.errors.HttpError and excep.resp.status == 400:
           # message id invalid, probably caused by stray files in the mail repo
-          print ("remote: message id: %s is invalid! are there any non-gmailieer files created in the gmailieer repository?" % gids[j])
+          print ("remote: message id: %s is invalid! are there any non-gmailieer files created in the gmailieer repository?" % gid (items[j]))
           j += 1
           return
 
-        elif type(excep) is googleapiclient.errors.HttpError and excep.resp.status == 403:
+        elif type(excep) is googleapiclient.errors.HttpError and excep.resp.status in (403, 429):
           raise Remote.UserRateException (excep)
 
         else:
@@ -268,48 +650,76 @@ class Remote:
       else:
         j += 1
 
-      msg_batch.append (resp)
+      responses.append (resp)
 
     while i < N:
       n = 0
       j = i
-      batch = self.service.new_batch_http_request  (callback = _cb)
+      max_req = self.rate.batch_size
+      nbytes  = 0
+      single  = size is not None and size (items[i]) > self.SINGLE_REQUEST_BYTES
 
-      while n < max_req and i < N:
-        gid = gids[i]
-        batch.add (self.service.users ().messages ().get (userId = self.account,
-          id = gid, format = format))
-        n += 1
-        i += 1
+      if not single:
+        batch = self.service.new_batch_http_request  (callback = _cb)
 
-      # we wait if there is a user_rate_delay
-      if user_rate_delay:
-        print ("remote: waiting %.1f seconds.." % user_rate_delay)
-        time.sleep (user_rate_delay)
+        while n < max_req and i < N:
+          if size is not None:
+            s = size (items[i])
+            if s > self.SINGLE_REQUEST_BYTES or (n > 0 and nbytes + s > self.BATCH_BYTES):
+              break
+            nbytes += s
+
+          batch.add (request (items[i]))
+          n += 1
+          i += 1
 
       try:
-        batch.execute (http = self.http)
+        if single:
+          # too large for a batch, rate limiting and retries are handled by
+          # __execute__.
+          self.stats.add ('single_requests')
+          try:
+            responses.append (self.__execute__ (method, request (items[i]), http))
+
+          except googleapiclient.errors.HttpError as excep:
+            if excep.resp.status in (400, 404):
+              print ("remote: could not get remote message: %s!" % gid (items[i]))
+            else:
+              raise
+
+          i += 1
+
+        else:
+          # wait for quota before taking a slot, so that an account that is
+          # backing off does not hold up the others (see sync-all)
+          self.__acquire__ (method, n)
+          with self.rate.slot ():
+            with self.stats.phase ('remote.' + method):
+              batch.execute (http = http)
 
-        # gradually reduce if we had 10 ok batches
-        user_rate_ok += 1
-        if user_rate_ok > 10:
-          user_rate_delay = user_rate_delay // 2
-          user_rate_ok    = 0
+          self.rate.success ()
 
         conn_errors = 0
 
-      except Remote.UserRateException as ex:
-        user_rate_delay = user_rate_delay * 2 + 1
-        print ("remote: user rate error, increasing delay to %s" % user_rate_delay)
-        user_rate_ok = 0
+      except Remote.UserRateException:
+        print ("remote: user rate error")
+        self.stats.add ('retries')
+        self.__request_done__ (False)
 
         i = j # reset
 
-      except Remote.BatchException as ex:
-        if max_req > self.MIN_BATCH_REQUEST_SIZE:
-          max_req = max_req / 2
+      except (Remote.BatchException, socket.timeout):
+        if lookup is not None and j < i and lookup (items[j:i], http):
+          # the batch may have been too large, pack the rest again by the
+          # sizes of the messages.
+          i = j # reset
+          self.stats.add ('retries')
+          print ("remote: batch failed, packing it again by the sizes of the messages")
+
+        elif self.rate.reduce_batch_size ():
           i = j # reset
-          print ("reducing batch request size to: %d" % max_req)
+          self.stats.add ('retries')
+          print ("reducing batch request size to: %d" % self.rate.batch_size)
         else:
           raise Remote.BatchException ("cannot reduce request any further")
 
@@ -317,39 +727,28 @@ class Remote:
         print ("connection failed, re-trying:", ex)
         i = j # reset
         conn_errors += 1
+        self.stats.add ('retries')
 
         time.sleep (1)
+        self.stats.add ('sleep_seconds', 1)
 
-        if conn_errors > MAX_CONNECTION_ERRORS:
+        if conn_errors > self.MAX_CONNECTION_ERRORS:
           print ("too many connection errors")
           raise
 
       finally:
         # handle batch
-        if len(msg_batch) > 0:
-          cb (msg_batch)
-          msg_batch.clear ()
+        if len(responses) > 0:
+          cb (responses)
+          responses = []
 
   @__require_auth__
   def get_message (self, gid, format = 'minimal'):
     """
     Get a single message
     """
-    self.__wait_delay__ ()
-    try:
-      result = self.service.users ().messages ().get (userId = self.account,
-          id = gid, format = format).execute ()
-
-    except googleapiclient.errors.HttpError as excep:
-      if excep.resp.status == 403 or excep.resp.status == 500:
-        self.__request_done__ (False)
-        return self.get_message (gid, format)
-      else:
-        raise
-
-    self.__request_done__ (True)
-
-    return result
+    return self.__execute__ ('messages.get', self.service.users ().messages ().get (userId = self.account,
+        id = gid, format = format))
 
   def authorize (self, reauth = False):
     if reauth:
@@ -360,13 +759,102 @@ class Remote:
 
     self.credentials = self.__get_credentials__ ()
 
-    timeout = self.gmailieer.local.state.timeout
-    if timeout == 0: timeout = None
+    self.timeout = self.gmailieer.local.state.timeout
+    if self.timeout == 0: self.timeout = None
+
+    self.transport = Remote.Transport (self.credentials, self.stats, self.timeout,
+                                       self.http_factory)
+    self.http = self.transport.new ()
+
+    with self.stats.phase ('remote.discovery'):
+      self.service = discovery.build_from_document (self.__discovery_document__ (), http = self.http)
 
-    self.http = self.credentials.authorize (httplib2.Http(timeout = timeout))
-    self.service = discovery.build ('gmail', 'v1', http = self.http)
     self.authorized = True
 
+  @staticmethod
+  def __valid_discovery__ (doc):
+    return (isinstance (doc, dict) and doc.get ('name') == 'gmail'
+            and doc.get ('version') == 'v1' and 'rootUrl' in doc
+            and 'resources' in doc)
+
+  def __fetch_discovery__ (self, url):
+    (resp, content) = Remote.Http (self.stats, timeout = self.timeout).request (url)
+    if resp.status != 200:
+      raise Remote.GenericException ("could not get discovery document: %d %s" % (resp.status, resp.reason))
+
+    doc = json.loads (content.decode ('utf-8'))
+    if not self.__valid_discovery__ (doc):
+      raise Remote.GenericException ("invalid discovery document from: %s" % url)
+
+    return doc
+
+  def __discovery_document__ (self):
+    """
+    Get the discovery document of the GMail API.
+
+    The document is cached in the XDG cache directory and fetched again when
+    it is older than DISCOVERY_TTL, or invalid. If it cannot be fetched an
+    expired copy is used.
+
+    The API may be pointed elsewhere (e.g. a local stand-in server for
+    benchmarking) by supplying a different discovery document with
+    GMAILIEER_DISCOVERY_URL, which is not cached.
+    """
+    discovery_url = os.environ.get ('GMAILIEER_DISCOVERY_URL', None)
+    if discovery_url is not None:
+      return self.__fetch_discovery__ (discovery_url)
+
+    cached = None
+    try:
+      with open (self.discovery_f, 'r') as fd:
+        cached = json.load (fd)
+
+      if not self.__valid_discovery__ (cached):
+        cached = None
+
+      elif time.time () - os.path.getmtime (self.discovery_f) < self.DISCOVERY_TTL:
+        return cached
+
+    except (OSError, ValueError):
+      cached = None
+
+    try:
+      doc = self.__fetch_discovery__ (self.DISCOVERY_URL)
+
+    except (OSError, ValueError, httplib2.HttpLib2Error, Remote.GenericException) as ex:
+      if cached is None:
+        raise
+
+      print ("remote: could not refresh discovery document, using cached copy:", ex)
+      return cached
+
+    try:
+      d = os.path.dirname (self.discovery_f)
+      os.makedirs (d, exist_ok = True)
+
+      (fd, tmp) = tempfile.mkstemp (dir = d, prefix = '.gmail-v1.json')
+      with os.fdopen (fd, 'w') as f:
+        json.dump (doc, f)
+      os.rename (tmp, self.discovery_f)
+
+    except OSError as ex:
+      print ("remote: could not cache discovery document:", ex)
+
+    return doc
+
+  @staticmethod
+  def valid_credentials (credential_path):
+    """
+    Whether there are stored credentials that can be used (or refreshed)
+    without going through the authorization flow
+    """
+    if not os.path.exists (credential_path):
+      return False
+
+    credentials = Storage (credential_path).get ()
+    return (credentials is not None and not credentials.invalid and
+            (credentials.refresh_token is not None or not credentials.access_token_expired))
+
   def __get_credentials__ (self):
     """
     Gets valid user credentials from storage.
@@ -383,6 +871,9 @@ class Remote:
     store = Storage(credential_path)
     credentials = store.get()
     if not credentials or credentials.invalid:
+      if not self.gmailieer.interactive:
+        raise Remote.GenericException ("no valid credentials, run `gmi auth` in %s" % self.gmailieer.local.wd)
+
       if self.CLIENT_SECRET_FILE is not None:
         # use user-provided client_secret
         print ("auth: using user-provided api id and secret")
@@ -446,26 +937,13 @@ class Remote:
 
     glabels = gmsg.get('labelIds', [])
 
-    # translate labels. Remote.get_labels () must have been called first
-    labels = []
-    for l in glabels:
-      ll = self.labels.get(l, None)
-
-      if ll is None and not self.gmailieer.local.state.drop_non_existing_label:
-        err = "error: GMail supplied a label that there exists no record for! You can `gmi set --drop-non-existing-labels` to work around the issue (https://github.com/gauteh/gmailieer/issues/48)"
-        print (err)
-        raise Remote.GenericException (err)
-      elif ll is None:
-        pass # drop
-      else:
-        labels.append (ll)
-
-    # remove ignored labels
-    labels = set(labels)
-    labels = labels - self.ignore_labels
+    # translate to notmuch tags. Remote.get_labels () must have been called first
+    labels = self.labels_to_tags (glabels)
 
-    # translate to notmuch tags
-    labels = set(self.gmailieer.label_translator.remote_labels_to_local(labels))
+    if labels is None:
+      err = "error: GMail supplied a label that there exists no record for! You can `gmi set --drop-non-existing-labels` to work around the issue (https://github.com/gauteh/gmailieer/issues/48)"
+      print (err)
+      raise Remote.GenericException (err)
 
     # current tags
     tags = set(nmsg.get_tags ())
@@ -505,15 +983,19 @@ class Remote:
         print ("(dry-run) gid: %s: add: %s, remove: %s" % (gid, str(add), str(rem)))
         return None
       else:
-        return self.__push_tags__ (gid, add, rem)
+        return self.__push_tags__ (gid, glabels, add, rem)
 
     else:
       return None
 
   @__require_auth__
-  def __push_tags__ (self, gid, add, rem):
+  def __push_tags__ (self, gid, labels, add, rem):
     """
-    Push message changes
+    Prepare message changes, `labels` are the current label ids of the
+    message.
+
+    Returns a tuple of (gid, current label ids, label ids to add, label ids to
+    remove) to be passed to push_changes ().
     """
 
     _add = []
@@ -524,98 +1006,79 @@ class Remote:
         (lid, ll) = self.__create_label__ (a)
         self.labels[lid]   = ll
         self.invlabels[ll] = lid
+        self.gmailieer.label_translator.compile (self.labels, self.ignore_labels)
         _add.append (lid)
       else:
         _add.append (_a)
 
     _rem = [self.invlabels[r] for r in rem]
 
-    body = { 'addLabelIds'    : _add,
-             'removeLabelIds' : _rem }
-
-    return self.service.users ().messages ().modify (userId = self.account,
-          id = gid, body = body)
+    return (gid, labels, _add, _rem)
 
   @__require_auth__
   def push_changes (self, actions, cb):
     """
     Push label changes
-    """
-    max_req = self.BATCH_REQUEST_SIZE
-    N       = len (actions)
-    i       = 0
-    j       = 0
 
-    # How much to wait before contacting the remote.
-    user_rate_delay     = 0
-    # How many requests with the current delay returned ok.
-    user_rate_ok        = 0
+    Actions with identical changes are grouped, and groups of at least
+    MIN_BATCH_MODIFY messages are pushed with messages.batchModify. The rest
+    are pushed with one messages.modify request each, sent in batches.
 
-    def _cb (rid, resp, excep):
-      nonlocal j
-      if excep is not None:
-        if type(excep) is googleapiclient.errors.HttpError and excep.resp.status == 404:
-          # message could not be found this is probably a deleted message, spam or draft
-          # message since these are not included in the messages.get() query by default.
-          print ("remote: could not find remote message: %s!" % gids[j])
-          j += 1
-          return
-
-        elif type(excep) is googleapiclient.errors.HttpError and excep.resp.status == 400:
-          # message id invalid, probably caused by stray files in the mail repo
-          print ("remote: message id: %s is invalid! are there any non-gmailieer files created in the gmailieer repository?" % gids[j])
-          j += 1
-          return
-
-        elif type(excep) is googleapiclient.errors.HttpError and excep.resp.status == 403:
-          raise Remote.UserRateException (excep)
-
-        else:
-          raise Remote.BatchException(excep)
-      else:
-        j += 1
-
-      cb (resp)
-
-    while i < N:
-      n = 0
-      j = i
-      batch = self.service.new_batch_http_request  (callback = _cb)
-
-      while n < max_req and i < N:
-        a = actions[i]
-        batch.add (a)
-        n += 1
-        i += 1
-
-      # we wait if there is a user_rate_delay
-      if user_rate_delay:
-        print ("remote: waiting %.1f seconds.." % user_rate_delay)
-        time.sleep (user_rate_delay)
-
-      try:
-        batch.execute (http = self.http)
-
-        # gradually reduce if we had 10 ok batches
-        user_rate_ok += 1
-        if user_rate_ok > 10:
-          user_rate_delay = user_rate_delay // 2
-          user_rate_ok    = 0
-
-      except Remote.UserRateException as ex:
-        user_rate_delay = user_rate_delay * 2 + 1
-        print ("remote: user rate error, increasing delay to %s" % user_rate_delay)
-        user_rate_ok = 0
-
-        i = j # reset
+    `cb` is called with the updated message (`id` and `labelIds`) for every
+    message that was changed.
+    """
 
-      except Remote.BatchException as ex:
-        if max_req > self.MIN_BATCH_REQUEST_SIZE:
-          max_req = max_req / 2
-          i = j # reset
-          print ("reducing batch request size to: %d" % max_req)
-        else:
-          raise Remote.BatchException ("cannot reduce request any further")
+    groups = OrderedDict ()
+    for a in actions:
+      (gid, labels, add, rem) = a
+      groups.setdefault ((tuple (sorted (add)), tuple (sorted (rem))), []).append (a)
+
+    single = []
+
+    for ((add, rem), acts) in groups.items ():
+      if len(acts) < self.MIN_BATCH_MODIFY:
+        single.extend (acts)
+        continue
+
+      for i in range (0, len(acts), self.BATCH_MODIFY_SIZE):
+        chunk = acts[i:i + self.BATCH_MODIFY_SIZE]
+        body  = { 'ids'            : [ a[0] for a in chunk ],
+                  'addLabelIds'    : list (add),
+                  'removeLabelIds' : list (rem) }
+
+        try:
+          self.__execute__ ('messages.batchModify', self.service.users ().messages ().batchModify (
+              userId = self.account, body = body))
+
+        except googleapiclient.errors.HttpError as excep:
+          if excep.resp.status in (400, 404):
+            # some of the messages are probably gone, modifying them one by
+            # one will skip those.
+            print ("remote: batch modify failed, modifying messages one by one: %s" % excep)
+            single.extend (chunk)
+            continue
+          else:
+            raise
+
+        for (gid, labels, _add, _rem) in chunk:
+          labels = [ l for l in labels if l not in rem ]
+          labels.extend (l for l in add if l not in labels)
+          cb ({ 'id' : gid, 'labelIds' : labels })
+
+    if len(single) > 0:
+      def _request (a):
+        body = { 'addLabelIds'    : a[2],
+                 'removeLabelIds' : a[3] }
+
+        return self.service.users ().messages ().modify (userId = self.account,
+            id = a[0], body = body)
+
+      def _got_resps (resps):
+        for resp in resps:
+          cb (resp)
+
+      self.__execute_batches__ ('messages.modify', single, _request,
+          lambda a: a[0], _got_resps, self.http)
 
   @__require_auth__
   def __create_label__ (self, l):
@@ -636,20 +1099,9 @@ class Remote:
                }
 
     if not self.dry_run:
-      self.__wait_delay__ ()
-      try:
-        lr = self.service.users ().labels ().create (userId = self.account, body = label).execute ()
-
-        return (lr['id'], l)
+      lr = self.__execute__ ('labels.create', self.service.users ().labels ().create (userId = self.account, body = label))
 
-      except googleapiclient.errors.HttpError as excep:
-        if excep.resp.status == 403 or excep.resp.status == 500:
-          self.__request_done__ (False)
-          return self.__create_label__ (l)
-        else:
-          raise
-
-      self.__request_done__ (True)
+      return (lr['id'], l)
 
     else:
       return (None, None)
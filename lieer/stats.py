@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+class Stats:
+  """
+  Timings and counters of a single run of gmi.
+
+  Phases are named sections of the run whose wall time is accumulated every
+  time they are entered. Phases may be nested, and phases entered from
+  several threads at once (such as concurrent requests) add up their times,
+  so the sum of the phases is not the duration of the run.
+
+  Counters are plain totals, e.g.:
+
+    requests        - GMail API requests, every request in a batch counts
+    quota_units     - GMail API quota units used
+    bytes           - bytes received from GMail
+    retries         - requests or batches that were re-tried
+    sleep_seconds   - time spent waiting for the rate limit or back-off, summed
+                      over threads
+
+  The summary can be written as JSON, or as a Prometheus text file for the
+  node_exporter textfile collector.
+  """
+
+  def __init__ (self):
+    self.lock     = threading.Lock ()
+    self.action   = None
+    self.account  = None
+
+    self.reset ()
+
+  def reset (self):
+    """
+    Start over, e.g. for the next synchronization of the daemon
+    """
+    with self.lock:
+      self.started  = time.time ()
+      self.t0       = time.perf_counter ()
+      self.duration = None
+      self.error    = None
+
+      self.phases   = OrderedDict () # name -> [ seconds, count ]
+      self.counters = OrderedDict ()
+
+  @contextmanager
+  def phase (self, name):
+    """
+    Time a phase
+    """
+    t0 = time.perf_counter ()
+    try:
+      yield
+
+    finally:
+      self.record (name, time.perf_counter () - t0)
+
+  def record (self, name, dt):
+    """
+    Add `dt` seconds spent in a phase, e.g. timed in pieces
+    """
+    with self.lock:
+      p = self.phases.get (name)
+      if p is None:
+        self.phases[name] = [ dt, 1 ]
+      else:
+        p[0] += dt
+        p[1] += 1
+
+  def add (self, counter, v = 1):
+    with self.lock:
+      self.counters[counter] = self.counters.get (counter, 0) + v
+
+  def merge (self, other):
+    """
+    Add the phases and counters of `other`, e.g. of the accounts synchronized
+    by sync-all
+    """
+    with other.lock:
+      phases   = [ (k, list (p)) for (k, p) in other.phases.items () ]
+      counters = list (other.counters.items ())
+
+    with self.lock:
+      for (k, (dt, n)) in phases:
+        p = self.phases.get (k)
+        if p is None:
+          self.phases[k] = [ dt, n ]
+        else:
+          p[0] += dt
+          p[1] += n
+
+      for (k, v) in counters:
+        self.counters[k] = self.counters.get (k, 0) + v
+
+  def finish (self, error = None):
+    self.duration = time.perf_counter () - self.t0
+    self.error    = error
+
+  def summary (self):
+    duration = self.duration if self.duration is not None else time.perf_counter () - self.t0
+
+    with self.lock:
+      return OrderedDict ([
+        ('action',   self.action),
+        ('account',  self.account),
+        ('started',  self.started),
+        ('duration', duration),
+        ('success',  self.error is None),
+        ('error',    self.error),
+        ('phases',   OrderedDict ((k, { 'seconds' : s, 'count' : c })
+                                  for (k, (s, c)) in self.phases.items ())),
+        ('counters', OrderedDict (self.counters)),
+        ])
+
+  @staticmethod
+  def __write_atomic__ (path, content):
+    """
+    Replace `path` in one go, so that a reader never sees a partial file
+    """
+    d = os.path.dirname (os.path.abspath (path))
+    (fd, tmp) = tempfile.mkstemp (dir = d, prefix = '.' + os.path.basename (path))
+    try:
+      with os.fdopen (fd, 'w') as f:
+        f.write (content)
+      os.chmod (tmp, 0o644)
+      os.rename (tmp, path)
+    except:
+      os.unlink (tmp)
+      raise
+
+  def write_json (self, path):
+    self.__write_atomic__ (path, json.dumps (self.summary (), indent = 2) + '\n')
+
+  def write_prometheus (self, path):
+    s = self.summary ()
+
+    def _escape (v):
+      return str(v).replace ('\\', '\\\\').replace ('"', '\\"').replace ('\n', '\\n')
+
+    def _labels (**extra):
+      l = OrderedDict ([ ('account', s['account'] or ''), ('action', s['action'] or '') ])
+      l.update (extra)
+      return '{' + ','.join ('%s="%s"' % (k, _escape (v)) for (k, v) in l.items ()) + '}'
+
+    lines = []
+    def _metric (name, help, values):
+      lines.append ('# HELP gmailieer_%s %s' % (name, help))
+      lines.append ('# TYPE gmailieer_%s gauge' % name)
+      for (labels, v) in values:
+        lines.append ('gmailieer_%s%s %s' % (name, labels, repr (float (v))))
+
+    _metric ('last_run_timestamp_seconds', 'Start time of the last run.',
+        [ (_labels (), s['started']) ])
+    _metric ('last_run_duration_seconds', 'Wall time of the last run.',
+        [ (_labels (), s['duration']) ])
+    _metric ('last_run_success', 'Whether the last run completed without errors.',
+        [ (_labels (), 1 if s['success'] else 0) ])
+    _metric ('last_run_phase_seconds', 'Accumulated wall time of each phase in the last run.',
+        [ (_labels (phase = k), p['seconds']) for (k, p) in s['phases'].items () ])
+    _metric ('last_run_phase_count', 'Number of times each phase was entered in the last run.',
+        [ (_labels (phase = k), p['count']) for (k, p) in s['phases'].items () ])
+
+    for (k, v) in s['counters'].items ():
+      _metric ('last_run_%s' % k, 'Total %s in the last run.' % k.replace ('_', ' '),
+          [ (_labels (), v) ])
+
+    self.__write_atomic__ (path, '\n'.join (lines) + '\n')